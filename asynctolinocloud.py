@@ -0,0 +1,589 @@
+#tolino cloud access module, asyncio flavour
+
+# AsyncTolinoCloud offers the same API as TolinoCloud, but all calls
+# to the tolino cloud are coroutines sharing a single httpx.AsyncClient.
+# Partner names, partner settings, the hardware id and the parsing of
+# responses come from TolinoCommon, the part of TolinoCloud that sends no
+# requests, so there is only one place to configure partners. The
+# helpers of TolinoCloud built on its blocking requests (bulk calls,
+# token refresh, prefetching, tracing) are not available here.
+#
+# Requires the httpx module (pip install httpx, see requirements-async.txt).
+
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+
+import asyncio
+import json
+import base64
+import os
+import re
+from urllib.parse import urlparse, parse_qs
+import logging
+import time
+import sys
+
+from tolinocloud import TolinoCloud, TolinoCommon, TolinoException
+
+
+class AsyncTolinoCloud(TolinoCommon):
+
+    # resume attempts for downloads
+    download_retries = 5
+
+    def __init__(self, partner_id, use_device=False, confpath='.tolinoclientrc', libpath='', pool_size=100, confsection='Defaults'):
+        sys.path.append(libpath)
+        import httpx
+        self.partner_id = partner_id
+        self.session = httpx.AsyncClient(
+            verify=True,
+            timeout=httpx.Timeout(60.0),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+        self.use_device = use_device
+        self.confpath = confpath
+        self.confsection = confsection
+        if partner_id == 0:
+            logging.info("Partner ID:")
+            for key, value in self.partner_name.items():
+                logging.info(f"  - partner_id: {key}, name: {value}")
+            raise SystemExit
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.session.aclose()
+
+    async def login(self, username, password):
+        s = self.session
+        c = self.partner_settings[self.partner_id]
+
+        if self.use_device:
+            TolinoCloud.hardware_id = username
+            if self.partner_id == 80:
+                self.access_token = password
+                return
+
+            r = await s.post(c['token_url'], data = {
+                'client_id'    : c['client_id'],
+                'grant_type'   : 'refresh_token',
+                'refresh_token': password,
+                'scope'        : c['scope'],
+                })
+            self._debug(r)
+            try:
+                j = r.json()
+                self.access_token = j['access_token']
+                self.refresh_token = j['refresh_token']
+                self.token_expires = int(j['expires_in'])
+                self._save_device_token()
+            except:
+                raise TolinoException('oauth access token request failed.')
+            return
+
+        # Login with partner site
+        # to retrieve site's cookies within browser session
+        if 'login_form_url' in c:
+            r = await s.get(c['login_form_url'], params = {
+                'client_id'     : c['client_id'],
+                'response_type' : 'code',
+                'scope'         : c['scope'],
+                'redirect_uri'  : c['reader_url'],
+                'x_buchde.skin_id': c['x_buchde.skin_id'],
+                'x_buchde.mandant_id' : c['x_buchde.mandant_id']
+            })
+        data = dict(c['login_form']['extra'])
+        data[c['login_form']['username']] = username
+        data[c['login_form']['password']] = password
+        r = await s.post(c['login_url'], data=data, follow_redirects=True)
+        self._debug(r)
+        if not c['login_cookie'] in s.cookies:
+            raise TolinoException('login to {} failed.'.
+                format(self.partner_name[self.partner_id]))
+        auth_code = ""
+        if 'tat_url' in c:
+            try:
+                r = await s.get(c['tat_url'], follow_redirects=True)
+                self._debug(r)
+                b64 = re.search(r'\&tat=(.*?)%3D', r.text).group(1)
+                self.access_token = base64.b64decode(b64+'==').decode('utf-8')
+            except:
+                raise TolinoException('oauth access token request failed.')
+        else:
+            # Request OAUTH code
+            params = {
+                'client_id'     : c['client_id'],
+                'response_type' : 'code',
+                'scope'         : c['scope'],
+                'redirect_uri'  : c['reader_url']
+            }
+            if 'login_form_url' in c:
+                params['x_buchde.skin_id'] = c['x_buchde.skin_id']
+                params['x_buchde.mandant_id'] = c['x_buchde.mandant_id']
+            r = await s.get(c['auth_url'], params=params)
+            self._debug(r)
+            try:
+                params = parse_qs(urlparse(r.headers['Location'].replace('#', '')).query)
+                auth_code = params['code'][0]
+            except:
+                raise TolinoException('oauth code request failed.')
+
+            # Fetch OAUTH access token
+            r = await s.post(c['token_url'], data = {
+                'client_id'    : c['client_id'],
+                'grant_type'   : 'authorization_code',
+                'code'         : auth_code,
+                'scope'        : c['scope'],
+                'redirect_uri' : c['reader_url']
+            })
+            self._debug(r)
+            try:
+                j = r.json()
+                self.access_token = j['access_token']
+                self.refresh_token = j['refresh_token']
+                self.token_expires = int(j['expires_in'])
+            except:
+                raise TolinoException('oauth access token request failed.')
+
+    async def logout(self):
+        if self.use_device:
+            return
+        s = self.session
+        c = self.partner_settings[self.partner_id]
+
+        if 'revoke_url' in c:
+            r = await s.post(c['revoke_url'],
+                data = {
+                    'client_id'  : c['client_id'],
+                    'token_type' : 'refresh_token',
+                    'token'      : self.refresh_token
+                }
+            )
+        else:
+            r = await s.post(c['logout_url'])
+        self._debug(r)
+        if r.status_code != 200:
+            raise TolinoException('logout failed.')
+
+    async def register(self):
+        if self.use_device:
+            return
+        s = self.session
+        c = self.partner_settings[self.partner_id]
+
+        # Register our hardware
+        r = await s.post(c['register_url'],
+              content = json.dumps({'hardware_name':'tolino sync reader'}),
+              headers = {
+                'content-type': 'application/json',
+                't_auth_token': self.access_token,
+                'hardware_id' : TolinoCloud.hardware_id,
+                'reseller_id' : str(self.partner_id),
+                'client_type': 'TOLINO_WEBREADER',
+                'client_version': '4.4.1',
+                'hardware_type': 'HTML5'
+              }
+        )
+        self._debug(r)
+        if r.status_code != 200:
+            raise TolinoException('register {} failed.'.format(TolinoCloud.hardware_id))
+
+    async def unregister(self, device_id = None):
+        if self.use_device:
+            return
+        if device_id is None:
+            device_id = TolinoCloud.hardware_id
+        s = self.session
+        c = self.partner_settings[self.partner_id]
+
+        r = await s.post(c['unregister_url'],
+            content = json.dumps({
+                'deleteDevicesRequest':{
+                    'accounts' : [ {
+                        'auth_token'  : self.access_token,
+                        'reseller_id' : self.partner_id
+                    } ],
+                    'devices'  : [ {
+                        'device_id'   : device_id,
+                        'reseller_id' : self.partner_id
+                    } ]
+                }
+            }),
+            headers = {
+                'content-type': 'application/json',
+                't_auth_token': self.access_token,
+                'reseller_id' : str(self.partner_id)
+            }
+        )
+        self._debug(r)
+        if r.status_code != 200:
+            try:
+                j = r.json()
+                raise TolinoException('unregister {} failed: {}'.format(device_id, j['ResponseInfo']['message']))
+            except (KeyError, ValueError):
+                raise TolinoException('unregister {} failed: reason unknown.'.format(device_id))
+
+    async def devices(self):
+        s = self.session
+        c = self.partner_settings[self.partner_id]
+
+        r = await s.post(c['devices_url'],
+            content = json.dumps({
+                'deviceListRequest':{
+                    'accounts' : [ {
+                        'auth_token'  : self.access_token,
+                        'reseller_id' : self.partner_id
+                    } ]
+                }
+            }),
+            headers = {
+                'content-type': 'application/json',
+                't_auth_token': self.access_token,
+                'reseller_id' : str(self.partner_id)
+            }
+        )
+        self._debug(r)
+        if r.status_code != 200:
+            raise TolinoException('device list request failed.')
+
+        try:
+            devs = []
+            j = r.json()
+            for item in j['deviceListResponse']['devices']:
+                devs.append({
+                    'id'         : item['deviceId'],
+                    'name'       : item['deviceName'],
+                    'type'       : {
+                        'unknown_imx50_rdp_1' : 'tolino shine',
+                        'tolino_vison'        : 'tolino vision',
+                        'HTML5_1'             : 'web browser'
+                        }.get(item['deviceType'], item['deviceType']),
+                    'partner'    : int(item['resellerId']),
+                    'registered' : int(item['deviceRegistered']),
+                    'lastusage'  : int(item['deviceLastUsage'])
+                })
+            return devs
+        except:
+            raise TolinoException('device list request failed.')
+
+    async def _inventory_request(self, revision=None):
+        s = self.session
+        c = self.partner_settings[self.partner_id]
+
+        params = {'strip': 'true'}
+        if revision is not None:
+            params['revision'] = revision
+        r = await s.get(c['inventory_url'],
+            params = params,
+            headers = {
+                't_auth_token' : self.access_token,
+                'hardware_id'  : TolinoCloud.hardware_id,
+                'reseller_id'  : str(self.partner_id)
+            }
+        )
+        self._debug(r)
+        if r.status_code != 200:
+            raise TolinoException('inventory list request failed.')
+        try:
+            return r.json()['PublicationInventory']
+        except:
+            raise TolinoException('inventory list request failed.')
+
+    async def inventory(self):
+        return self._parse_inventory(await self._inventory_request())
+
+    async def inventory_delta(self, revision=None, known_ids=()):
+        return self._inventory_delta(await self._inventory_request(revision), revision, known_ids)
+
+    async def upload(self, filename, name = None, ext = None):
+        s = self.session
+        c = self.partner_settings[self.partner_id]
+
+        if name is None:
+            name = filename.split('/')[-1]
+        if ext is None:
+            ext = filename.split('.')[-1]
+
+        mime = {
+            'pdf'  : 'application/pdf',
+            'epub' : 'application/epub+zip'
+        }.get(ext.lower(), 'application/pdf')
+
+        with open(filename, 'rb') as f:
+            r = await s.post(c['upload_url'],
+                files = [('file', (name, f, mime))],
+                headers = {
+                    't_auth_token' : self.access_token,
+                    'hardware_id'  : TolinoCloud.hardware_id,
+                    'reseller_id'  : str(self.partner_id)
+                }
+            )
+        self._debug(r)
+        if r.status_code != 200:
+            raise TolinoException('file upload failed.')
+
+        try:
+            j = r.json()
+            return j['metadata']['deliverableId']
+        except:
+            raise TolinoException('file upload failed.')
+
+    async def add_cover(self, book_id, filename, name = None, ext = None):
+        s = self.session
+        c = self.partner_settings[self.partner_id]
+
+        if 'cover_url' not in c:
+            raise TolinoException('no cover url defined for this provider.')
+
+        if ext is None:
+            ext = filename.split('.')[-1]
+
+        mime = {
+            'png': 'image/png',
+            'jpeg': 'image/jpeg',
+            'jpg': 'image/jpeg'
+        }.get(ext.lower(), 'application/jpeg')
+
+        with open(filename, 'rb') as f:
+            r = await s.post(c['cover_url'],
+                files = [('file', ('1092560016', f, mime))],
+                data = {'deliverableId': book_id},
+                headers = {
+                    't_auth_token' : self.access_token,
+                    'hardware_id'  : TolinoCloud.hardware_id,
+                    'reseller_id'  : str(self.partner_id)
+                }
+            )
+        self._debug(r)
+        if r.status_code != 200:
+            raise TolinoException('cover upload failed.')
+
+    async def metadata(self, book_id, title=None, subtitle=None, author=None, publisher=None, isbn=None, edition=None,
+                issued=None, language=None):
+        s = self.session
+        c = self.partner_settings[self.partner_id]
+
+        if 'meta_url' not in c:
+            raise TolinoException('no meta url defined for this provider.')
+
+        b = c['meta_url'] + '/?deliverableId={book_id}'.format(book_id=book_id)
+        headers = {
+            't_auth_token': self.access_token,
+            'hardware_id': TolinoCloud.hardware_id,
+            'reseller_id': str(self.partner_id)
+        }
+        r = await s.get(b, headers=headers)
+        self._debug(r)
+        if r.status_code != 200:
+            raise TolinoException('meta data request failed.')
+
+        try:
+            meta = r.json()
+            meta['metadata']
+        except (KeyError, TypeError, ValueError):
+            raise TolinoException('meta data request failed.')
+
+        changes = self.metadata_changes(meta['metadata'], title=title, subtitle=subtitle, author=author,
+                                        publisher=publisher, isbn=isbn, edition=edition, issued=issued,
+                                        language=language)
+        # nothing to write if the book has these values already
+        if not changes:
+            return meta['metadata'].get('deliverableId')
+        for field, (old, new) in changes.items():
+            meta['metadata'][field] = new
+
+        payload = {
+            'uploadMetaData': meta['metadata']
+        }
+
+        r = await s.put(b,
+                  content=json.dumps(payload),
+                  headers=dict(headers, **{'content-type': 'application/json'})
+                  )
+        self._debug(r)
+        if r.status_code != 200:
+            raise TolinoException('meta data update failed.')
+
+        try:
+            return meta['metadata']['deliverableId']
+        except:
+            raise TolinoException('meta data update failed.')
+
+    async def add_to_collection(self, book_id, collection_name):
+        s = self.session
+        c = self.partner_settings[self.partner_id]
+
+        if 'sync_data_url' not in c:
+            raise TolinoException('no meta url defined for this provider.')
+
+        payload = {
+            "revision":None,
+            "patches":[
+                {
+                    "op":"add",
+                    "value":{
+                        "modified":round(time.time() * 1000), #Milliseconds
+                        "name":collection_name,
+                        "category":"collection",
+                    },
+                    "path":"/publications/{book_id}/tags".format(book_id=book_id)
+                }
+            ]
+        }
+
+        r = await s.patch(c['sync_data_url'],
+                    content=json.dumps(payload),
+                    headers={
+                        'content-type': 'application/json',
+                        't_auth_token': self.access_token,
+                        'hardware_id': TolinoCloud.hardware_id,
+                        'reseller_id': str(self.partner_id),
+                        'client_type': 'TOLINO_WEBREADER'
+                    }
+                )
+        self._debug(r)
+        if r.status_code != 200:
+            raise TolinoException('collection update failed.')
+
+    async def delete(self, id):
+        s = self.session
+        c = self.partner_settings[self.partner_id]
+
+        r = await s.get(c['delete_url'],
+            params = {
+                'deliverableId': id
+            },
+            headers = {
+                't_auth_token' : self.access_token,
+                'hardware_id'  : TolinoCloud.hardware_id,
+                'reseller_id'  : str(self.partner_id)
+            }
+        )
+        self._debug(r)
+        if r.status_code != 200:
+            try:
+                j = r.json()
+                raise TolinoException('delete {} failed: {}'.format(id, j['ResponseInfo']['message']))
+            except (KeyError, ValueError):
+                raise TolinoException('delete {} failed: reason unknown.'.format(id))
+
+    async def download_info(self, id):
+        s = self.session
+        c = self.partner_settings[self.partner_id]
+
+        b64 = base64.b64encode(bytes(id, 'utf-8')).decode('utf-8')
+        r = await s.get(c['downloadinfo_url'].format(b64, b64),
+            headers = {
+                't_auth_token' : self.access_token,
+                'hardware_id'  : TolinoCloud.hardware_id,
+                'reseller_id'  : str(self.partner_id)
+            }
+        )
+        self._debug(r)
+        if r.status_code != 200:
+            raise TolinoException('download info request failed.')
+
+        j = r.json()
+        url = j['DownloadInfo']['contentUrl']
+        return {
+            'url'      : url,
+            'filename' : url.split('/')[-1],
+            'filetype' : j['DownloadInfo']['format'],
+        }
+
+    async def download(self, path, id, filename=None):
+        # as TolinoCloud.download: the body is written to a .part file,
+        # renamed once it is complete; interrupted transfers continue
+        # with a range request where the .part file ends
+        import httpx
+
+        di = await self.download_info(id)
+        if filename is None:
+            filename = di['filename']
+        if path:
+            filename = path + '/' + filename
+
+        part_filename = filename + '.part'
+        retries = 0
+        while True:
+            offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+            headers = {
+                't_auth_token' : self.access_token,
+                'hardware_id'  : TolinoCloud.hardware_id,
+                'reseller_id'  : str(self.partner_id)
+            }
+            if offset > 0:
+                headers['Range'] = 'bytes={}-'.format(offset)
+            try:
+                async with self.session.stream('GET', di['url'], follow_redirects=True, headers=headers) as r:
+                    size = await self._write_part(r, part_filename, offset)
+            except httpx.TransportError as e:
+                retries += 1
+                if retries > self.download_retries:
+                    raise TolinoException('download request failed: {}'.format(e))
+                logging.info('download of {} interrupted ({}), resuming.'.format(id, e))
+                await asyncio.sleep(min(30, 0.5 * 2 ** retries))
+                continue
+
+            if size is not None:
+                os.replace(part_filename, filename)
+                return filename
+
+            # size mismatch, the connection was closed early
+            retries += 1
+            if retries > self.download_retries:
+                raise TolinoException('download request failed: incomplete transfer.')
+            logging.info('download of {} incomplete, resuming.'.format(id))
+            await asyncio.sleep(min(30, 0.5 * 2 ** retries))
+
+    async def _write_part(self, r, part_filename, offset):
+        # returns the size of the complete file or None if the transfer
+        # ended before all bytes arrived
+        if r.status_code == 416 and offset > 0:
+            m = re.match(r'bytes \*/(\d+)', r.headers.get('Content-Range', ''))
+            if m and int(m.group(1)) == offset:
+                return offset
+            os.remove(part_filename)
+            return None
+        if r.status_code == 206:
+            m = re.match(r'bytes (\d+)-\d+/(\d+|\*)', r.headers.get('Content-Range', ''))
+            if not m or int(m.group(1)) != offset:
+                raise TolinoException('download request failed: unexpected content range.')
+            total = int(m.group(2)) if m.group(2) != '*' else None
+            mode = 'ab'
+        elif r.status_code == 200:
+            # range not supported, start over
+            total = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+            mode = 'wb'
+        else:
+            await r.aread()
+            self._debug(r)
+            try:
+                j = r.json()
+                raise TolinoException('download request failed: {}'.format(j['ResponseInfo']['message']))
+            except (KeyError, ValueError):
+                raise TolinoException('download request : reason unknown.')
+
+        if r.headers.get('Content-Encoding', 'identity') != 'identity':
+            # the length refers to the encoded body
+            total = None
+        with open(part_filename, mode) as f:
+            async for chunk in r.aiter_bytes(chunk_size=65536):
+                f.write(chunk)
+            size = f.tell()
+        if total is not None and size != total:
+            return None
+        return size
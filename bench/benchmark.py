@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# end-to-end benchmark of tolino-cloud-backup.py against the local
+# mock cloud (see mockcloud.py)
+#
+#   python bench/benchmark.py                      # all scenarios
+#   python bench/benchmark.py -s flaky --jobs 8
+#   python bench/benchmark.py --json result.json
+#   python bench/benchmark.py --baseline result.json   # fail on regressions
+#
+# Every scenario starts a fresh mock cloud, runs a complete backup into an
+# empty directory in a separate process and reports items/s, MB/s and the
+# p50/p99 latency per item (from the download info request of a book until
+# its last byte was sent).
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from mockcloud import MockCloud, MOCK_PARTNER_ID, percentile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+MB = 1024 * 1024
+
+scenarios = {
+    'many-small' : dict(books=300, min_size=64 * 1024, max_size=512 * 1024, latency=0.02),
+    'large-pdfs' : dict(books=20, min_size=8 * MB, max_size=32 * MB),
+    'slow-links' : dict(books=60, min_size=MB, max_size=4 * MB, latency=0.1, bandwidth=2 * MB),
+    'flaky'      : dict(books=100, min_size=256 * 1024, max_size=2 * MB, latency=0.02,
+                        error_rate=0.05, drop_rate=0.05),
+    'throttled'  : dict(books=100, min_size=MB, max_size=2 * MB, latency=0.02, bandwidth=4 * MB,
+                        max_transfers=6),
+}
+
+BOOTSTRAP = '''
+import runpy, sys
+sys.path[:0] = [{repo!r}, {bench!r}]
+import mockcloud
+mockcloud.install_partner({url!r})
+sys.argv = ['tolino-cloud-backup.py'] + {argv!r}
+runpy.run_path({script!r}, run_name='__main__')
+'''
+
+
+def run_scenario(name, settings, backup_args):
+    cloud = MockCloud(**settings).start()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            config = os.path.join(tmp, 'tolinoclientrc')
+            with open(config, 'w') as f:
+                f.write('[Defaults]\nuser = bench\npassword = bench\npartner = {}\n'.format(MOCK_PARTNER_ID))
+            argv = ['--config', config, '--download-dir', os.path.join(tmp, 'target')] + backup_args
+            code = BOOTSTRAP.format(repo=REPO_DIR, bench=BENCH_DIR, url=cloud.url, argv=argv,
+                                    script=os.path.join(REPO_DIR, 'tolino-cloud-backup.py'))
+            start = time.perf_counter()
+            p = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+            wall = time.perf_counter() - start
+        if p.returncode != 0:
+            sys.stderr.write(p.stderr)
+            raise SystemExit('backup failed in scenario {}'.format(name))
+        m = re.search(r'Failures: (\d+)', p.stderr)
+        stats = cloud.stats
+        books = len(cloud.books)
+        return {
+            'scenario'  : name,
+            'books'     : books,
+            'failures'  : int(m.group(1)) if m else None,
+            'wall'      : wall,
+            'items_s'   : books / wall,
+            'mb_s'      : stats['bytes'] / MB / wall,
+            'p50'       : percentile(stats['latencies'], 50),
+            'p99'       : percentile(stats['latencies'], 99),
+            'requests'  : stats['requests'],
+            'errors'    : stats['errors'],
+            'drops'     : stats['drops'],
+            'throttled' : stats['throttled']
+        }
+    finally:
+        cloud.stop()
+
+
+def fmt(v, spec):
+    return '-' if v is None else format(v, spec)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='end-to-end backup benchmark against a local mock cloud.')
+    parser.add_argument('-s', '--scenario', action='append', choices=sorted(scenarios), help='scenario to run (default: all)')
+    parser.add_argument('--json', metavar='FILE', help='write the results to FILE')
+    parser.add_argument('--baseline', metavar='FILE', help='compare items/s with the results in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline (default: 0.2)')
+    args, backup_args = parser.parse_known_args()
+
+    results = []
+    print('{:<12} {:>6} {:>5} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'scenario', 'books', 'fail', 'wall s', 'items/s', 'MB/s', 'p50 s', 'p99 s'))
+    for name in args.scenario or sorted(scenarios):
+        r = run_scenario(name, scenarios[name], backup_args)
+        results.append(r)
+        print('{:<12} {:>6} {:>5} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+            name, r['books'], fmt(r['failures'], 'd'), fmt(r['wall'], '.2f'), fmt(r['items_s'], '.1f'),
+            fmt(r['mb_s'], '.1f'), fmt(r['p50'], '.3f'), fmt(r['p99'], '.3f')))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = dict((r['scenario'], r) for r in json.load(f))
+        regressions = []
+        for r in results:
+            b = baseline.get(r['scenario'])
+            if b and r['items_s'] < b['items_s'] * (1 - args.tolerance):
+                regressions.append('{}: {:.1f} items/s, baseline {:.1f}'.format(r['scenario'], r['items_s'], b['items_s']))
+        for line in regressions:
+            print('REGRESSION ' + line)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,503 @@
+#local stand-in for the tolino cloud
+
+# MockCloud serves the endpoints TolinoCloud needs for a backup on
+# localhost: partner login, oauth token, registerhw, inventory/delta,
+# downloadinfo and the book contents (with Range support), as well as
+# upload, deletecontent, cover, meta and sync-data (collections). Library size,
+# file sizes, latency, bandwidth and error rates are configurable, so
+# backup throughput can be measured without touching pageplace.de.
+#
+# partner_settings(url) returns a partner entry for TolinoCloud that
+# points at a running server, it is registered as partner id 99:
+#
+#   server = MockCloud(books=500).start()
+#   install_partner(server.url)
+#   c = TolinoCloud(MOCK_PARTNER_ID)
+
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+
+import argparse
+import base64
+import http.server
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+MOCK_PARTNER_ID = 99
+
+# book contents are slices of this block, repeated
+_BLOCK = bytes(random.Random(0).getrandbits(8) for _ in range(64 * 1024))
+
+
+def partner_settings(url):
+    return {
+        'client_id'        : 'mock',
+        'scope'            : 'SCOPE_BOSH',
+        'token_url'        : url + '/partner/oauth2/token',
+        'auth_url'         : url + '/partner/oauth2/authorize',
+        'login_url'        : url + '/partner/login',
+        'login_form'       : {
+            'username' : 'username',
+            'password' : 'password',
+            'extra'    : {}
+        },
+        'login_cookie'     : 'MOCKSESSION',
+        'logout_url'       : url + '/partner/logout',
+        'reader_url'       : 'https://webreader.mytolino.com/library/index.html#/mybooks/titles',
+        'register_url'     : url + '/bosh/rest/v2/registerhw',
+        'devices_url'      : url + '/bosh/rest/handshake/devices/list',
+        'unregister_url'   : url + '/bosh/rest/handshake/devices/delete',
+        'upload_url'       : url + '/bosh/rest/upload',
+        'cover_url'        : url + '/bosh/rest/cover',
+        'delete_url'       : url + '/bosh/rest/deletecontent',
+        'meta_url'         : url + '/bosh/rest/meta',
+        'sync_data_url'    : url + '/bosh/rest/sync-data?paths=publications,audiobooks',
+        'inventory_url'    : url + '/bosh/rest/inventory/delta',
+        'downloadinfo_url' : url + '/bosh/rest//cloud/downloadinfo/{}/{}/type/external-download'
+    }
+
+
+def install_partner(url):
+    from tolinocloud import TolinoCloud
+    TolinoCloud.partner_name[MOCK_PARTNER_ID] = 'mock cloud'
+    TolinoCloud.partner_settings[MOCK_PARTNER_ID] = partner_settings(url)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class MockCloud:
+
+    def __init__(self, books=100, min_size=256 * 1024, max_size=4 * 1024 * 1024,
+                 latency=0.0, bandwidth=0, error_rate=0.0, drop_rate=0.0,
+                 max_transfers=0, url_ttl=300, token_ttl=3600, seed=0, port=0):
+        # latency   : seconds added to every request
+        # bandwidth : bytes per second and connection for contents, 0 = unlimited
+        # error_rate: probability of a 503 answer on downloadinfo and contents
+        # drop_rate : probability of closing the connection halfway through a content
+        # max_transfers : contents sent at once before answering 429, 0 = unlimited
+        # token_ttl : lifetime of access tokens in seconds
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.max_transfers = max_transfers
+        self.transfers = 0
+        self.url_ttl = url_ttl
+        self.token_ttl = token_ttl
+        self.tokens = {}
+        self.port = port
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.revision = '1'
+        self.uploads = 0
+        self.books = {}
+        for n in range(books):
+            id = 'mock_{}_{:08d}'.format('3' if n % 5 else '6', n)
+            self.books[id] = {
+                'id'        : id,
+                'title'     : 'Book {}'.format(n),
+                'author'    : 'Author{} Mock'.format(n % 37),
+                'mime'      : 'application/pdf' if n % 3 == 0 else 'application/epub+zip',
+                'type'      : 'EDATA' if n % 5 == 0 else 'EBOOK',
+                'purchased' : 1500000000000 + n * 1000,
+                'size'      : self.random.randint(min_size, max_size)
+            }
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {
+                'requests'     : 0,
+                'errors'       : 0,
+                'drops'        : 0,
+                'throttled'    : 0,
+                'meta_puts'    : 0,
+                'sync_patches' : 0,
+                'deletes'      : 0,
+                'bytes'        : 0,
+                'info_started' : {},
+                'latencies'    : []
+            }
+
+    def content(self, id, start, end):
+        # deterministic content of a book, bytes start..end-1
+        size = len(_BLOCK)
+        out = bytearray()
+        pos = start
+        while pos < end:
+            o = pos % size
+            n = min(size - o, end - pos)
+            out += _BLOCK[o:o + n]
+            pos += n
+        return bytes(out)
+
+    def start(self):
+        handler = type('Handler', (_Handler,), {'cloud': self})
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', self.port), handler)
+        self.server.daemon_threads = True
+        # clients closing connections early are part of the game
+        self.server.handle_error = lambda request, client_address: None
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def new_token(self):
+        with self.lock:
+            token = 'mock-access-{}'.format(len(self.tokens))
+            self.tokens[token] = time.time() + self.token_ttl
+        return token
+
+    def valid_token(self, token):
+        with self.lock:
+            return self.tokens.get(token, 0) > time.time()
+
+    def _fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def _drop(self):
+        with self.lock:
+            return self.random.random() < self.drop_rate
+
+
+def _inventory_item(book):
+    return {
+        'resellerId'   : str(MOCK_PARTNER_ID),
+        'epubMetaData' : {
+            'identifier'  : book['id'],
+            'title'       : book['title'],
+            'subtitle'    : None,
+            'author'      : [{'name': book['author']}],
+            'type'        : book['type'],
+            'issued'      : None,
+            'deliverable' : [{
+                'contentFormat' : book['mime'],
+                'purchased'     : book['purchased']
+            }]
+        }
+    }
+
+
+def _metadata(book):
+    return book.get('meta') or {
+        'deliverableId' : book['id'],
+        'title'         : book['title'],
+        'subtitle'      : '',
+        'author'        : book['author'],
+        'publisher'     : '',
+        'isbn'          : '',
+        'edition'       : 1,
+        'language'      : 'de'
+    }
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    cloud = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, j, status=200, headers={}):
+        body = json.dumps(j).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _begin(self):
+        cloud = self.cloud
+        with cloud.lock:
+            cloud.stats['requests'] += 1
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+        if cloud.latency:
+            time.sleep(cloud.latency)
+        return urlparse(self.path)
+
+    def do_POST(self):
+        u = self._begin()
+        if u.path == '/partner/login':
+            self._send_json({}, headers={'Set-Cookie': 'MOCKSESSION=1; Path=/'})
+        elif u.path == '/partner/oauth2/token':
+            self._send_json({
+                'access_token'  : self.cloud.new_token(),
+                'refresh_token' : 'mock-refresh-token',
+                'expires_in'    : self.cloud.token_ttl
+            })
+        elif not self._authorized(u):
+            return
+        elif u.path in ('/partner/logout', '/bosh/rest/v2/registerhw',
+                        '/bosh/rest/handshake/devices/delete'):
+            self._send_json({})
+        elif u.path == '/bosh/rest/handshake/devices/list':
+            self._send_json({'deviceListResponse': {'devices': []}})
+        elif u.path == '/bosh/rest/upload':
+            self._upload()
+        elif u.path == '/bosh/rest/cover':
+            self._send_json({} if b'name="deliverableId"' in self.body else {'ResponseInfo': {'message': 'no id'}},
+                            200 if b'name="deliverableId"' in self.body else 400)
+        else:
+            self._send_json({}, 404)
+
+    def _authorized(self, u):
+        if not u.path.startswith('/bosh/') or self.cloud.valid_token(self.headers.get('t_auth_token')):
+            return True
+        self._send_json({'ResponseInfo': {'message': 'invalid token'}}, 401)
+        return False
+
+    def do_GET(self):
+        u = self._begin()
+        cloud = self.cloud
+        if not self._authorized(u):
+            return
+        elif u.path == '/partner/oauth2/authorize':
+            self.send_response(302)
+            self.send_header('Location', 'https://webreader.mytolino.com/library/index.html#/mybooks/titles?code=mock-code')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif u.path == '/bosh/rest/inventory/delta':
+            q = parse_qs(u.query)
+            books = []
+            if q.get('revision', [None])[0] != cloud.revision:
+                books = list(cloud.books.values())
+            self._send_json({'PublicationInventory': {
+                'revision' : cloud.revision,
+                'edata'    : [_inventory_item(b) for b in books if b['type'] == 'EDATA'],
+                'ebook'    : [_inventory_item(b) for b in books if b['type'] == 'EBOOK']
+            }})
+        elif u.path.startswith('/bosh/rest//cloud/downloadinfo/'):
+            self._download_info(u)
+        elif u.path.startswith('/content/'):
+            self._content(u)
+        elif u.path == '/bosh/rest/meta/':
+            book = cloud.books.get(parse_qs(u.query).get('deliverableId', [''])[0])
+            if book is None:
+                self._send_json({'ResponseInfo': {'message': 'unknown deliverableId'}}, 404)
+                return
+            self._send_json({'metadata': _metadata(book)})
+        elif u.path == '/bosh/rest/deletecontent':
+            id = parse_qs(u.query).get('deliverableId', [''])[0]
+            with cloud.lock:
+                book = cloud.books.pop(id, None)
+                if book is not None:
+                    cloud.stats['deletes'] += 1
+                    cloud.revision = str(int(cloud.revision) + 1)
+            if book is None:
+                self._send_json({'ResponseInfo': {'message': 'unknown deliverableId'}}, 404)
+            else:
+                self._send_json({})
+        else:
+            self._send_json({}, 404)
+
+    def do_PUT(self):
+        u = self._begin()
+        cloud = self.cloud
+        if not self._authorized(u):
+            return
+        book = cloud.books.get(parse_qs(u.query).get('deliverableId', [''])[0])
+        if u.path != '/bosh/rest/meta/' or book is None:
+            self._send_json({}, 404)
+            return
+        with cloud.lock:
+            cloud.stats['meta_puts'] += 1
+            book['meta'] = json.loads(self.body)['uploadMetaData']
+            book['title'] = book['meta'].get('title') or book['title']
+        self._send_json({})
+
+    def do_PATCH(self):
+        # all patches of a request are applied, or none if one of them
+        # names an unknown book or operation
+        u = self._begin()
+        cloud = self.cloud
+        if not self._authorized(u):
+            return
+        if u.path != '/bosh/rest/sync-data':
+            self._send_json({}, 404)
+            return
+        patches = json.loads(self.body)['patches']
+        changes = []
+        for patch in patches:
+            m = re.match(r'/publications/([^/]+)/tags$', patch.get('path', ''))
+            if m is None or m.group(1) not in cloud.books or patch.get('op') not in ('add', 'remove'):
+                self._send_json({'ResponseInfo': {'message': 'invalid patch {}'.format(patch.get('path'))}}, 400)
+                return
+            changes.append((cloud.books[m.group(1)], patch['op'], patch['value']['name']))
+        with cloud.lock:
+            cloud.stats['sync_patches'] += len(patches)
+            for book, op, name in changes:
+                tags = book.setdefault('tags', set())
+                if op == 'add':
+                    tags.add(name)
+                else:
+                    tags.discard(name)
+        self._send_json({})
+
+    def _upload(self):
+        cloud = self.cloud
+        m = re.search(rb'filename="([^"]*)"\r\nContent-Type: ([^\r]*)\r\n\r\n', self.body)
+        if m is None:
+            self._send_json({'ResponseInfo': {'message': 'no file'}}, 400)
+            return
+        # the content ends before the closing boundary
+        size = len(self.body) - m.end() - len(self.body.split(b'\r\n', 1)[0]) - 6
+        with cloud.lock:
+            id = 'mock_upload_{:08d}'.format(len(cloud.books) + cloud.uploads)
+            cloud.uploads += 1
+            cloud.books[id] = {
+                'id'        : id,
+                'title'     : m.group(1).decode('utf-8').rsplit('.', 1)[0],
+                'author'    : 'Uploaded',
+                'mime'      : m.group(2).decode('utf-8'),
+                'type'      : 'EDATA',
+                'purchased' : int(time.time() * 1000),
+                'size'      : size
+            }
+            cloud.revision = str(int(cloud.revision) + 1)
+        self._send_json({'metadata': {'deliverableId': id}})
+
+    def _download_info(self, u):
+        cloud = self.cloud
+        id = base64.b64decode(u.path.split('/')[6]).decode('utf-8')
+        if id not in cloud.books:
+            self._send_json({'ResponseInfo': {'message': 'unknown deliverableId'}}, 404)
+            return
+        if cloud._fail():
+            with cloud.lock:
+                cloud.stats['errors'] += 1
+            self._send_json({'ResponseInfo': {'message': 'service unavailable'}}, 503)
+            return
+        with cloud.lock:
+            cloud.stats['info_started'].setdefault(id, time.perf_counter())
+        ext = 'pdf' if cloud.books[id]['mime'] == 'application/pdf' else 'epub'
+        self._send_json({'DownloadInfo': {
+            'contentUrl' : '{}/content/{}.{}?Expires={}'.format(cloud.url, id, ext, int(time.time() + cloud.url_ttl)),
+            'format'     : ext.upper()
+        }})
+
+    def _content(self, u):
+        cloud = self.cloud
+        id = u.path.split('/')[-1].rsplit('.', 1)[0]
+        q = parse_qs(u.query)
+        if id not in cloud.books or int(q.get('Expires', ['0'])[0]) < time.time():
+            self._send_json({'ResponseInfo': {'message': 'access denied'}}, 403)
+            return
+        if cloud._fail():
+            with cloud.lock:
+                cloud.stats['errors'] += 1
+            self._send_json({'ResponseInfo': {'message': 'service unavailable'}}, 503)
+            return
+        with cloud.lock:
+            throttled = cloud.max_transfers and cloud.transfers >= cloud.max_transfers
+            if throttled:
+                cloud.stats['throttled'] += 1
+            else:
+                cloud.transfers += 1
+        if throttled:
+            self._send_json({'ResponseInfo': {'message': 'too many requests'}}, 429, {'Retry-After': '1'})
+            return
+        try:
+            self._send_content(id)
+        finally:
+            with cloud.lock:
+                cloud.transfers -= 1
+
+    def _send_content(self, id):
+        cloud = self.cloud
+        size = cloud.books[id]['size']
+        start = 0
+        m = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if m:
+            start = int(m.group(1))
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', cloud.books[id]['mime'])
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+
+        drop_at = None
+        if cloud._drop():
+            drop_at = start + (size - start) // 2
+        chunk = 64 * 1024
+        pos = start
+        began = time.perf_counter()
+        while pos < size:
+            end = min(size, pos + chunk)
+            if drop_at is not None and end > drop_at:
+                self.wfile.write(cloud.content(id, pos, drop_at))
+                self.wfile.flush()
+                with cloud.lock:
+                    cloud.stats['drops'] += 1
+                    cloud.stats['bytes'] += drop_at - pos
+                self.close_connection = True
+                return
+            self.wfile.write(cloud.content(id, pos, end))
+            with cloud.lock:
+                cloud.stats['bytes'] += end - pos
+            pos = end
+            if cloud.bandwidth:
+                ahead = (pos - start) / cloud.bandwidth - (time.perf_counter() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        with cloud.lock:
+            began = cloud.stats['info_started'].pop(id, None)
+            if began is not None:
+                cloud.stats['latencies'].append(time.perf_counter() - began)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local stand-in for the tolino cloud.')
+    parser.add_argument('--port', type=int, default=8077)
+    parser.add_argument('--books', type=int, default=100, help='library size')
+    parser.add_argument('--min-size', type=int, default=256 * 1024, help='smallest book in bytes')
+    parser.add_argument('--max-size', type=int, default=4 * 1024 * 1024, help='largest book in bytes')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=int, default=0, help='bytes per second and connection')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 503 answer')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability of a dropped connection')
+    parser.add_argument('--max-transfers', type=int, default=0, help='parallel contents before answering 429')
+    args = parser.parse_args()
+
+    cloud = MockCloud(args.books, args.min_size, args.max_size, args.latency, args.bandwidth,
+                      args.error_rate, args.drop_rate, args.max_transfers, port=args.port).start()
+    print('mock tolino cloud listening on {}, partner settings:'.format(cloud.url))
+    print(json.dumps(partner_settings(cloud.url), indent=2))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        cloud.stop()
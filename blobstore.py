@@ -0,0 +1,140 @@
+#content-addressed store for backed up books
+
+# Every book is kept once in the store, under its SHA-256:
+#
+#   <store>/ab/abcdef0123...
+#
+# The readable file names in the download directories are hardlinks (or
+# reflinks, on file systems supporting them) to these blobs. A book that
+# is part of several accounts or partners therefore takes its disk space
+# only once, as long as store and download directories are on the same
+# file system.
+
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+
+import logging
+import os
+import sys
+import threading
+
+# ioctl cloning a whole file, from linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    # copy-on-write copy of src, fails unless the file system
+    # (btrfs, xfs, ...) supports it
+    if not sys.platform.startswith('linux'):
+        raise OSError('reflinks are only supported on Linux')
+    import fcntl
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class BlobStore:
+
+    link_modes = ('hardlink', 'reflink')
+
+    def __init__(self, root, link='hardlink'):
+        if link not in self.link_modes:
+            raise ValueError('unknown link mode {}'.format(link))
+        self.root = root
+        self.link = link
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def add(self, filename, sha256):
+        # moves the content of filename into the store and replaces the
+        # file with a link to the blob; returns True if the blob was
+        # there already, i.e. the file has been deduplicated
+        blob = self.path(sha256)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if self.link == 'hardlink':
+            src = filename
+        else:
+            # the blob gets an inode of its own
+            src = '{}.{}.{}.tmp'.format(blob, os.getpid(), threading.get_ident())
+            self._link(filename, src)
+        try:
+            # atomic, so concurrent runs agree on which copy is the blob
+            os.link(src, blob)
+            return False
+        except FileExistsError:
+            pass
+        finally:
+            if src != filename:
+                os.remove(src)
+        if os.path.samefile(filename, blob):
+            return False
+        tmp = filename + '.link'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        self._link(blob, tmp)
+        os.replace(tmp, filename)
+        return True
+
+    def linked(self, filename, sha256):
+        # whether filename shares the disk space of its blob. A reflink
+        # cannot be told from a copy by its metadata, so in reflink mode
+        # a file of the blob's size on the store's file system counts
+        blob = self.path(sha256)
+        try:
+            if os.path.samefile(filename, blob):
+                return True
+            if self.link != 'reflink':
+                return False
+            st, blob_st = os.stat(filename), os.stat(blob)
+        except OSError:
+            return False
+        return st.st_dev == blob_st.st_dev and st.st_size == blob_st.st_size
+
+    def _link(self, src, dst):
+        if self.link == 'reflink':
+            try:
+                reflink(src, dst)
+                return
+            except OSError as e:
+                logging.debug('reflink of {} failed ({}), using a hardlink.'.format(src, e))
+                if os.path.exists(dst):
+                    os.remove(dst)
+        os.link(src, dst)
+
+
+def dedup_report(store, manifests):
+    # compares the size of the backed up books linked to the store with
+    # the size of their blobs; manifests is a list of (download directory,
+    # Manifest). Books not linked to the store (added before --store was
+    # used, or on another file system) save nothing and are only counted.
+    files = 0
+    unlinked = 0
+    logical = 0
+    blobs = {}
+    for directory, manifest in manifests:
+        for path, sha256, size in manifest.checksums():
+            if not store.linked(os.path.join(directory, path), sha256):
+                unlinked += 1
+                continue
+            files += 1
+            logical += size
+            blobs[sha256] = size
+    physical = sum(blobs.values())
+    return {
+        'files'    : files,
+        'unlinked' : unlinked,
+        'blobs'    : len(blobs),
+        'logical'  : logical,
+        'physical' : physical,
+        'saved'    : logical - physical
+    }
@@ -0,0 +1,117 @@
+#local manifest of backed up books
+
+# The manifest is a small SQLite database within the download directory.
+# It maps the tolino document id of every downloaded book to its local
+# file, so a backup run can decide by id whether a book is already there,
+# even if its title or author (and therefore its file name) has changed.
+
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+
+import os
+import sqlite3
+import hashlib
+import threading
+
+MANIFEST_FILENAME = '.tolino-manifest.sqlite'
+
+
+def sha256_file(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+
+    columns = ('id', 'path', 'size', 'sha256', 'mime', 'purchased')
+
+    def __init__(self, filename):
+        # the connection is shared by all download workers
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS books (
+                    id        TEXT PRIMARY KEY,
+                    path      TEXT NOT NULL,
+                    size      INTEGER NOT NULL,
+                    sha256    TEXT NOT NULL,
+                    mime      TEXT,
+                    purchased INTEGER
+                )''')
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS state (
+                    key   TEXT PRIMARY KEY,
+                    value TEXT
+                )''')
+
+    def get(self, id):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT {} FROM books WHERE id = ?'.format(', '.join(self.columns)),
+                (id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(self.columns, row))
+
+    def ids(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT id FROM books')]
+
+    def missing(self, directory):
+        # ids of the books whose file in directory is gone or does not
+        # have the recorded size any more
+        with self.lock:
+            rows = self.db.execute('SELECT id, path, size FROM books').fetchall()
+        missing = []
+        for id, path, size in rows:
+            try:
+                if os.path.getsize(os.path.join(directory, path)) == size:
+                    continue
+            except OSError:
+                pass
+            missing.append(id)
+        return missing
+
+    def checksums(self):
+        # (path, sha256, size) of every book
+        with self.lock:
+            return self.db.execute('SELECT path, sha256, size FROM books').fetchall()
+
+    def put(self, id, path, size, sha256, mime=None, purchased=None):
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO books ({}) VALUES (?, ?, ?, ?, ?, ?)'.format(', '.join(self.columns)),
+                (id, path, size, sha256, mime, purchased))
+
+    def rename(self, id, path):
+        with self.lock, self.db:
+            self.db.execute('UPDATE books SET path = ? WHERE id = ?', (path, id))
+
+    def get_state(self, key, default=None):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_state(self, key, value):
+        with self.lock, self.db:
+            if value is None:
+                self.db.execute('DELETE FROM state WHERE key = ?', (key,))
+            else:
+                self.db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
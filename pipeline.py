@@ -0,0 +1,185 @@
+#staged producer / consumer pipeline
+
+# A Pipeline passes the items of a source iterable through a chain of
+# stages. Every stage has its own worker threads and reads its items from
+# a queue, which may be bounded, so a slow stage holds up the stages in
+# front of it instead of piling up work. A stage function returns the item
+# for the next stage, or None to drop it (e.g. a book that is already
+# there); exceptions listed in `errors` mark the item as failed.
+#
+# Each stage counts its items, failures and busy time and samples the
+# depth of its queue, so the bottleneck of a run can be seen in stats():
+#
+#   p = Pipeline(books, [Stage('plan', plan), Stage('transfer', transfer, workers=8)])
+#   failures = p.run()
+
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+
+import queue
+import threading
+from time import perf_counter
+
+# marks the end of the items in a queue, once per worker
+_END = object()
+
+
+class Stage:
+
+    def __init__(self, name, func, workers=1, queue_size=0):
+        # queue_size bounds the input queue of the stage, 0 is unbounded
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(queue_size)
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.running = self.workers
+        self.items = 0
+        self.passed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.depth_sum = 0
+        self.started = None
+        self.finished = None
+
+    def stats(self):
+        with self.lock:
+            end = self.finished if self.finished is not None else perf_counter()
+            elapsed = end - self.started if self.started is not None else 0.0
+            return {
+                'stage'     : self.name,
+                'workers'   : self.workers,
+                'items'     : self.items,
+                'passed'    : self.passed,
+                'failed'    : self.failed,
+                'depth'     : self.queue.qsize(),
+                'max_depth' : self.max_depth,
+                'avg_depth' : self.depth_sum / self.items if self.items else 0.0,
+                'busy'      : self.busy,
+                'elapsed'   : elapsed,
+                'rate'      : self.items / elapsed if elapsed > 0 else 0.0,
+                # share of the worker time spent in the stage function
+                'load'      : self.busy / (elapsed * self.workers) if elapsed > 0 else 0.0
+            }
+
+
+class Pipeline:
+
+    def __init__(self, source, stages, errors=(Exception,), on_error=None, source_name='source'):
+        # on_error(stage, item, exception) is called for every failed item
+        self.source = source
+        self.source_name = source_name
+        self.source_started = None
+        self.source_finished = None
+        self.stages = stages
+        self.errors = errors
+        self.on_error = on_error
+        self.failures = []
+        self.source_items = 0
+        self.fatal = None
+        self.lock = threading.Lock()
+
+    def _feed(self):
+        first = self.stages[0]
+        self.source_started = perf_counter()
+        try:
+            for item in self.source:
+                self.source_items += 1
+                first.queue.put(item)
+        except BaseException as e:
+            with self.lock:
+                self.fatal = self.fatal or e
+        self.source_finished = perf_counter()
+        for _ in range(first.workers):
+            first.queue.put(_END)
+
+    def _work(self, n):
+        stage = self.stages[n]
+        after = self.stages[n + 1] if n + 1 < len(self.stages) else None
+        while True:
+            depth = stage.queue.qsize()
+            item = stage.queue.get()
+            if item is _END:
+                with stage.lock:
+                    stage.running -= 1
+                    last = stage.running == 0
+                    if last:
+                        stage.finished = perf_counter()
+                if last and after is not None:
+                    for _ in range(after.workers):
+                        after.queue.put(_END)
+                return
+            t0 = perf_counter()
+            with stage.lock:
+                if stage.started is None:
+                    stage.started = t0
+                stage.items += 1
+                stage.max_depth = max(stage.max_depth, depth)
+                stage.depth_sum += depth
+            try:
+                result = stage.func(item)
+            except self.errors as e:
+                result = None
+                with self.lock:
+                    self.failures.append((stage.name, item, e))
+                with stage.lock:
+                    stage.failed += 1
+                if self.on_error is not None:
+                    self.on_error(stage.name, item, e)
+            except BaseException as e:
+                # a bug, not a failed item: finish the run, then raise it
+                result = None
+                with self.lock:
+                    self.fatal = self.fatal or e
+            finally:
+                with stage.lock:
+                    stage.busy += perf_counter() - t0
+            if result is not None:
+                with stage.lock:
+                    stage.passed += 1
+                if after is not None:
+                    after.queue.put(result)
+
+    def run(self):
+        # returns the failures as (stage name, item, exception)
+        threads = [threading.Thread(target=self._feed, daemon=True)]
+        for n, stage in enumerate(self.stages):
+            threads += [threading.Thread(target=self._work, args=(n,), daemon=True) for _ in range(stage.workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if self.fatal is not None:
+            raise self.fatal
+        return self.failures
+
+    def stats(self):
+        # the source comes first, its rate is how fast it produced items
+        end = self.source_finished if self.source_finished is not None else perf_counter()
+        elapsed = end - self.source_started if self.source_started is not None else 0.0
+        source = {
+            'stage'     : self.source_name,
+            'workers'   : 1,
+            'items'     : self.source_items,
+            'passed'    : self.source_items,
+            'failed'    : 0,
+            'depth'     : 0,
+            'max_depth' : 0,
+            'avg_depth' : 0.0,
+            'busy'      : elapsed,
+            'elapsed'   : elapsed,
+            'rate'      : self.source_items / elapsed if elapsed > 0 else 0.0,
+            'load'      : 1.0 if elapsed > 0 else 0.0
+        }
+        return [source] + [stage.stats() for stage in self.stages]
@@ -5,8 +5,18 @@ import configparser
 import argparse
 import re
 import os
+import threading
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-from tolinocloud import TolinoCloud, TolinoException
+from requests.exceptions import RequestException
+
+from tolinocloud import TolinoCloud, TolinoException, TokenCache, AdaptiveLimit, BandwidthLimit
+from manifest import Manifest, MANIFEST_FILENAME, sha256_file
+from blobstore import BlobStore, dedup_report
+from pipeline import Pipeline, Stage
+from tolinometrics import RunMetrics, write_json, write_prometheus
 
 def safe_filename(input_string, replacement_char='_'):
     # Replace any character that is not alphanumeric or a valid file character with '_'
@@ -22,6 +32,285 @@ def get_author(book):
         name_components = first_author.split(' ')
         return name_components[len(name_components) - 1]
 
+def parse_size(value):
+    # '512K', '4M', '1G' or plain bytes
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = str(value).strip().upper()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def parse_rate(value):
+    # '20M' or '20M,08:00-18:00=5M,22:00-06:00=0': a default rate in bytes
+    # per second and optional windows by time of day, 0 is unlimited
+    rate = 0
+    windows = []
+    for part in str(value).split(','):
+        m = re.match(r'\s*(\d\d?):(\d\d)-(\d\d?):(\d\d)=(.+)$', part)
+        if m:
+            start = int(m.group(1)) * 60 + int(m.group(2))
+            end = int(m.group(3)) * 60 + int(m.group(4))
+            windows.append((start, end, parse_size(m.group(5))))
+        else:
+            rate = parse_size(part)
+    return rate, windows
+
+# inventory items read ahead of the planning
+PLAN_QUEUE_SIZE = 1000
+
+file_extensions = {
+    "application/epub+zip": "epub",
+    "application/pdf": "pdf",
+}
+
+def plan_book(manifest, download_dir, book_no, book):
+    # returns the file name to download the book to, or None
+    # if a local copy exists already
+    id = book['id']
+    author = get_author(book)
+    title = book['title']
+    mimetype = book['mime']
+    file_ext = file_extensions[mimetype]
+    filename = safe_filename(f"{author}__{title}__{id}.{file_ext}")
+    logging.info(f"Downloading #{book_no} ({id}): {author} {title} ({mimetype}) to {filename} ...")
+    file_path = f"{download_dir}/{filename}"
+
+    entry = manifest.get(id)
+    if entry is not None:
+        old_path = f"{download_dir}/{entry['path']}"
+        if os.path.exists(old_path) and os.path.getsize(old_path) == entry['size']:
+            if entry['path'] != filename:
+                # title or author changed in the cloud
+                os.rename(old_path, file_path)
+                manifest.rename(id, filename)
+                logging.info(f"Renamed {old_path} to {file_path}.")
+            else:
+                logging.info(f"Skipping download of {file_path} because it does already exist.")
+            return None
+    elif os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+        # downloaded before the manifest was introduced
+        manifest.put(id, filename, os.path.getsize(file_path), sha256_file(file_path), mimetype, book['purchased'])
+        logging.info(f"Skipping download of {file_path} because it does already exist.")
+        return None
+    return filename
+
+def prefetch_book(c, metrics, item):
+    t0 = perf_counter()
+    try:
+        c.prefetch_download_info(item['book']['id'])
+    except (TolinoException, RequestException):
+        # the transfer asks again and reports the error
+        pass
+    metrics.download_info(perf_counter() - t0)
+    return item
+
+def transfer_book(c, limiter, metrics, download_dir, item):
+    # a resumed download only transfers the rest of the .part file
+    part_path = f"{download_dir}/{item['filename']}.part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    limiter.acquire()
+    try:
+        t0 = perf_counter()
+        # the checksum is computed while the body streams in
+        filename, item['sha256'] = c.download(download_dir, item['book']['id'], item['filename'], sha256=True)
+        metrics.transfer(perf_counter() - t0, os.path.getsize(filename) - offset)
+        limiter.increase()
+    finally:
+        limiter.release()
+    return item
+
+def finalize_book(manifest, store, metrics, download_dir, item):
+    with metrics.phase('finalize'):
+        return _finalize_book(manifest, store, download_dir, item)
+
+def _finalize_book(manifest, store, download_dir, item):
+    book = item['book']
+    file_path = f"{download_dir}/{item['filename']}"
+    size = os.path.getsize(file_path)
+    if store is not None:
+        try:
+            if store.add(file_path, item['sha256']):
+                logging.info(f"{file_path} is a duplicate, linked to {store.path(item['sha256'])}.")
+        except OSError as e:
+            # e.g. store and download directory on different file systems
+            logging.warning(f"Could not add {file_path} to the store: {e}")
+    manifest.put(book['id'], item['filename'], size, item['sha256'], book['mime'], book['purchased'])
+    return item
+
+def log_pipeline_stats(pipeline, final=True):
+    if not final:
+        logging.info('Queues: ' + ', '.join(f"{s['stage']} {s['depth']} waiting, {s['items']} taken" for s in pipeline.stats()[1:]))
+        return
+    logging.info(f"{'stage':<10} {'workers':>7} {'items':>6} {'failed':>6} {'items/s':>8} {'load':>5} {'queue max':>9} {'avg':>6}")
+    for s in pipeline.stats():
+        logging.info(f"{s['stage']:<10} {s['workers']:>7} {s['items']:>6} {s['failed']:>6} {s['rate']:>8.1f} "
+                     f"{s['load']:>5.0%} {s['max_depth']:>9} {s['avg_depth']:>6.1f}")
+
+def log_dedup_report(store, download_dirs):
+    manifests = [(download_dir, Manifest(f"{download_dir}/{MANIFEST_FILENAME}")) for download_dir in download_dirs]
+    try:
+        report = dedup_report(store, manifests)
+    finally:
+        for download_dir, manifest in manifests:
+            manifest.close()
+    mb = 1024 * 1024
+    logging.info(f"Store {store.root}: {report['files']} files, {report['blobs']} distinct contents, "
+                 f"{report['logical'] / mb:.1f} MB backed up in {report['physical'] / mb:.1f} MB, "
+                 f"{report['saved'] / mb:.1f} MB saved.")
+    if report['unlinked']:
+        logging.info(f"  {report['unlinked']} files are not linked to the store.")
+
+def section_options(confparse, section):
+    # 'download-dir = ...' and 'download_dir = ...' both set args.download_dir
+    if not confparse.has_section(section):
+        return {}
+    return {key.replace('-', '_'): value for key, value in confparse.items(section)}
+
+def setup_logging(args, account=None):
+    level = logging.DEBUG if args.debug else logging.INFO
+    if account is None:
+        logging.basicConfig(level=level)
+    else:
+        # several accounts log into the same terminal
+        logging.basicConfig(level=level, format=f'%(levelname)s:{account}:%(message)s', force=True)
+
+def write_metrics(args, runs):
+    # runs are RunMetrics.to_dict() of every account
+    if args.metrics_file:
+        write_prometheus(args.metrics_file, runs)
+    if args.metrics_json:
+        write_json(args.metrics_json, runs)
+
+def backup(args, path, section='Defaults', metrics=None):
+    # back up one account, returns the number of books in the
+    # inventory (delta) and the books whose download failed;
+    # metrics is a RunMetrics filled in along the way
+    if metrics is None:
+        metrics = RunMetrics(section)
+    jobs = max(1, int(args.jobs))
+    max_jobs = max(jobs, int(args.max_jobs))
+    prefetch = max(1, int(args.prefetch)) if args.prefetch else jobs
+
+    download_dir = args.download_dir
+    logging.info(f"Use download-dir: {download_dir}")
+    os.makedirs(download_dir, exist_ok=True)
+
+    # Connect and gather list of books online
+    token_cache = TokenCache(args.token_cache) if args.token_cache else None
+    c = TolinoCloud(args.partner, args.use_device, path, pool_size=max_jobs + prefetch, token_cache=token_cache, confsection=section)
+    # fewer parallel transfers while the cloud answers 429 / 503,
+    # more again as long as downloads succeed
+    limiter = AdaptiveLimit(jobs, maximum=max_jobs)
+    c.limiter = limiter
+    if args.buffer_size:
+        c.download_buffer_size = parse_size(args.buffer_size)
+    if args.max_rate:
+        rate, windows = parse_rate(args.max_rate)
+        c.bandwidth = BandwidthLimit(rate, windows)
+    store = BlobStore(args.store, args.store_link) if args.store else None
+    if args.trace:
+        from tolinotrace import Tracer, JsonlTraceSink
+        c.set_tracer(Tracer(JsonlTraceSink(args.trace)))
+    with metrics.phase('login'):
+        c.login(args.user, args.password)
+    with metrics.phase('register'):
+        c.register()
+
+    # only ask for the changes since the last complete run
+    manifest = Manifest(f"{download_dir}/{MANIFEST_FILENAME}")
+    revision = None if args.full_sync else manifest.get_state('inventory_revision')
+    if revision is not None:
+        # the delta would not list books whose local copy went missing
+        missing = manifest.missing(download_dir)
+        if missing:
+            logging.info(f"{len(missing)} books are missing or incomplete locally, fetching the full inventory.")
+            revision = None
+    known_ids = set(manifest.ids())
+    info = {}
+    seen_ids = set()
+
+    def plan(item):
+        seen_ids.add(item['book']['id'])
+        with metrics.phase('plan'):
+            item['filename'] = plan_book(manifest, download_dir, item['book_no'], item['book'])
+        return None if item['filename'] is None else item
+
+    def failed(stage, item, e):
+        book = item['book']
+        logging.warning(f"Downloading {book['id']} ({book['title']}) failed in {stage}! Reason: {e}")
+
+    # inventory -> plan/skip -> download info -> transfer -> finalize,
+    # every stage with workers of its own. The inventory is spooled to a
+    # temporary file, so its connection is not held open by a slow run,
+    # and read ahead of the planning by at most PLAN_QUEUE_SIZE books,
+    # which keeps the memory of a large library bounded. The download
+    # infos are requested ahead of the transfers, but never more than
+    # `prefetch` books, otherwise their signed urls might expire before
+    # they are used.
+    books = ({'book_no': book_no, 'book': book} for book_no, book in enumerate(c.iter_inventory(revision, info, spool=True), start=1))
+    pipeline = Pipeline(books, [
+        Stage('plan', plan, workers=int(args.plan_jobs), queue_size=PLAN_QUEUE_SIZE),
+        Stage('info', partial(prefetch_book, c, metrics), workers=prefetch, queue_size=prefetch),
+        Stage('transfer', partial(transfer_book, c, limiter, metrics, download_dir), workers=max_jobs, queue_size=prefetch),
+        Stage('finalize', partial(finalize_book, manifest, store, metrics, download_dir), workers=int(args.finalize_jobs), queue_size=max_jobs)
+    ], errors=(TolinoException, OSError), on_error=failed, source_name='inventory')
+    done = threading.Event()
+    if args.stats_interval:
+        def report():
+            while not done.wait(float(args.stats_interval)):
+                log_pipeline_stats(pipeline, final=False)
+        threading.Thread(target=report, daemon=True).start()
+    try:
+        failed_items = [item['book'] for stage, item, e in pipeline.run()]
+    finally:
+        done.set()
+    book_cnt = len(seen_ids)
+
+    stats = dict((s['stage'], s) for s in pipeline.stats())
+    metrics.add_phase('inventory', stats['inventory']['elapsed'])
+    metrics.set_items('downloaded', stats['finalize']['passed'])
+    metrics.set_items('skipped', stats['plan']['items'] - stats['plan']['passed'] - stats['plan']['failed'])
+    metrics.set_items('failed', len(failed_items))
+
+    added = len(seen_ids - known_ids)
+    removed = c.inventory_removed(info, revision, known_ids, seen_ids)
+    logging.info(f"Inventory: {added} new, {book_cnt - added} changed, {len(removed)} removed books.")
+    for id in removed:
+        logging.info(f"  - {id} was removed from the cloud, keeping the local copy.")
+
+    # failed books would be missing in the next delta,
+    # so the revision is only stored after a complete run
+    if not failed_items:
+        manifest.set_state('inventory_revision', info.get('revision'))
+    manifest.close()
+
+    if args.use_device == False and not args.token_cache:
+        c.unregister()
+        c.logout()
+
+    log_pipeline_stats(pipeline)
+    logging.info(f"Downloaded {book_cnt} items to {download_dir}. Failures: {len(failed_items)}.")
+    for item in failed_items:
+        logging.warning(f"  - {item['id']}: {item['title']}")
+    return book_cnt, failed_items
+
+def backup_account(account, args, path):
+    # runs in a worker process, one per account
+    setup_logging(args, account)
+    metrics = RunMetrics(account)
+    try:
+        book_cnt, failed_items = backup(args, path, account, metrics)
+    except Exception as e:
+        # one broken account must not stop the others
+        reason = str(e) if isinstance(e, TolinoException) else repr(e)
+        logging.error(f"Backup failed! Reason: {reason}")
+        metrics.finish(reason)
+        return {'account': account, 'download_dir': args.download_dir, 'books': 0, 'failed': [], 'error': reason,
+                'metrics': metrics.to_dict()}
+    metrics.finish()
+    return {'account': account, 'download_dir': args.download_dir, 'books': book_cnt, 'failed': failed_items, 'error': None,
+            'metrics': metrics.to_dict()}
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='cmd line client to access personal tolino cloud storage space.'
@@ -35,9 +324,11 @@ if __name__ == '__main__':
     if args.config:
         path = args.config
     confparse.read([path])
-    conf = dict(confparse.items('Defaults'))
+    conf = section_options(confparse, 'Defaults')
 
-    parser.set_defaults(**conf)
+    # every other section with a user is an account of its own,
+    # settings missing there are taken from [Defaults]
+    accounts = [name for name in confparse.sections() if name != 'Defaults' and confparse.has_option(name, 'user')]
 
     parser.add_argument('--user', type=str, help='username (usually an email address)')
     parser.add_argument('--password', type=str, help='password')
@@ -45,59 +336,76 @@ if __name__ == '__main__':
     parser.add_argument('--use-device', action="store_true", help='use existing device credentials instead of signing in')
     parser.add_argument('--debug', action="store_true", help='log additional debugging info')
     parser.add_argument('--download-dir', type=str, help='path to the download directory')
+    parser.add_argument('--buffer-size', type=str, help='bytes read at a time per transfer, e.g. 256K or 4M (default: 1M)')
+    parser.add_argument('--max-rate', type=str, help='limit the total download bandwidth in bytes per second, e.g. 20M, optionally by time of day: 20M,08:00-18:00=5M')
+    parser.add_argument('--token-cache', metavar='FILE', help='keep the session in FILE and reuse it in the next run')
+    parser.add_argument('--store', metavar='DIR', help='keep every book once in DIR, by SHA-256, and link the downloaded files to it')
+    parser.add_argument('--store-link', choices=BlobStore.link_modes, default='hardlink', help='how files are linked to the store (default: hardlink)')
+    parser.add_argument('--trace', metavar='FILE', help='append a JSON line per HTTP request to FILE')
+    parser.add_argument('--full-sync', action="store_true", help='fetch the full inventory instead of the changes since the last run')
+    parser.add_argument('--jobs', type=int, default=4, help='number of parallel downloads to start with (default: 4)')
+    parser.add_argument('--max-jobs', type=int, default=16, help='upper limit for parallel downloads while the cloud keeps up (default: 16)')
+    parser.add_argument('--prefetch', type=int, help='number of download infos to request ahead of the downloads (default: same as --jobs)')
+    parser.add_argument('--plan-jobs', type=int, default=1, help='workers checking which books are there already (default: 1)')
+    parser.add_argument('--finalize-jobs', type=int, default=2, help='workers recording finished downloads (default: 2)')
+    parser.add_argument('--stats-interval', type=float, help='log the queue depth of every stage each SECONDS')
+    parser.add_argument('--metrics-file', metavar='FILE', help='write the metrics of the run to FILE for the Prometheus node exporter textfile collector')
+    parser.add_argument('--metrics-json', metavar='FILE', help='write the metrics of the run to FILE as JSON')
+    parser.add_argument('--account', action='append', help='only back up this account section of the config file (repeatable, default: all)')
 
+    # after all add_argument() calls, their default= would win otherwise
+    parser.set_defaults(**conf)
     args = parser.parse_args(remaining_argv)
 
-    if args.debug:
-        logging.basicConfig(level=logging.DEBUG)
-    else:
-        logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger()
-
-    # Initialise counters
-    book_cnt = 0
+    if args.account:
+        unknown = [name for name in args.account if name not in accounts]
+        if unknown:
+            parser.error(f"no account section {', '.join(unknown)} in {path}")
+        accounts = args.account
 
-    download_dir = args.download_dir
-    logging.info(f"Use download-dir: {download_dir}")
-    os.makedirs(download_dir, exist_ok=True)
-
-    # Connect and gather list of books online
-    c = TolinoCloud(args.partner, args.use_device, path)
-    c.login(args.user, args.password)
-    c.register()
-    remote = c.inventory()
-
-    file_extensions = {
-        "application/epub+zip": "epub",
-        "application/pdf": "pdf",
-    }
-
-    # download all books
-    failed_items = []
-    for book in remote:
-        book_cnt += 1
-        id = book['id']
-        author = get_author(book)
-        title = book['title']
-        mimetype = book['mime']
-        file_ext = file_extensions[mimetype]
-        filename = safe_filename(f"{author}__{title}__{id}.{file_ext}")
-        logger.info(f"Downloading #{book_cnt} ({id}): {author} {title} ({mimetype}) to {filename} ...")
-        file_path = f"{download_dir}/{filename}"
-        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-            try:
-                dl_path = c.download(download_dir, id)
-                os.rename(dl_path, file_path)
-            except TolinoException as e:
-                failed_items.append(book)
-                logging.warning(f"Downloading {id} ({title}) failed! Reason: {e}")
-        else:
-            logging.info(f"Skipping download of {file_path} because it does already exist.")
+    setup_logging(args)
+    if not accounts:
+        metrics = RunMetrics('Defaults')
+        try:
+            backup(args, path, metrics=metrics)
+        except Exception as e:
+            metrics.finish(str(e) if isinstance(e, TolinoException) else repr(e))
+            write_metrics(args, [metrics.to_dict()])
+            raise
+        metrics.finish()
+        write_metrics(args, [metrics.to_dict()])
+        if args.store:
+            log_dedup_report(BlobStore(args.store, args.store_link), [args.download_dir])
+    else:
+        # options given on the command line beat the account section,
+        # which beats [Defaults]
+        sections = {name: section_options(confparse, name) for name in accounts}
+        defaults = {key: parser.get_default(key) for options in sections.values() for key in options}
+        account_args = {}
+        for name in accounts:
+            parser.set_defaults(**dict(defaults, **sections[name]))
+            account_args[name] = parser.parse_args(remaining_argv)
+        with ProcessPoolExecutor(max_workers=len(accounts)) as executor:
+            results = list(executor.map(backup_account, accounts, [account_args[name] for name in accounts], [path] * len(accounts)))
 
-    if args.use_device == False:
-        c.unregister()
-        c.logout()
+        write_metrics(args, [r['metrics'] for r in results])
 
-    logging.info(f"Downloaded {book_cnt} items to {download_dir}. Failures: {len(failed_items)}.")
-    for item in failed_items:
-        logging.warning(f"  - {item['id']}: {item['title']}")
+        logging.info(f"Backed up {len(results)} accounts:")
+        for r in results:
+            if r['error']:
+                logging.warning(f"  {r['account']}: failed: {r['error']}")
+            else:
+                logging.info(f"  {r['account']}: {r['books']} items to {r['download_dir']}. Failures: {len(r['failed'])}.")
+        # one report per store, the accounts may use different ones
+        stores = {}
+        for r in results:
+            account = account_args[r['account']]
+            if account.store and not r['error']:
+                stores.setdefault((account.store, account.store_link), []).append(r['download_dir'])
+        for (root, link), download_dirs in stores.items():
+            log_dedup_report(BlobStore(root, link), download_dirs)
+        failures = sum(len(r['failed']) for r in results) + sum(1 for r in results if r['error'])
+        logging.info(f"Failures: {failures}.")
+        for r in results:
+            for item in r['failed']:
+                logging.warning(f"  - {r['account']}: {item['id']}: {item['title']}")
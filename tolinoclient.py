@@ -6,23 +6,145 @@
 
 import configparser
 import argparse
+import csv
 import json
 import sys
+import os
 import datetime
 import logging
+import signal
+import socket
+import socketserver
+import threading
 from os.path import expanduser
 import datetime
 
-from tolinocloud import TolinoCloud
-
-def inventory(args):
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from tolinocloud import TolinoCloud, TolinoException, TokenCache, select_inventory
+
+# calls `tolinoclient.py serve` carries out for the other subcommands
+daemon_ops = ('inventory', 'devices', 'unregister', 'upload', 'download', 'delete',
+              'metadata', 'bulk_metadata', 'add_cover', 'add_to_collection',
+              'remove_from_collection', 'bulk_collections', 'bulk_delete')
+
+class RemoteCloud:
+
+    # Stands in for TolinoCloud when `tolinoclient.py serve` is running:
+    # every call is sent as one JSON line over the Unix socket and carried
+    # out with the warm session of the daemon.
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.f = self.sock.makefile('rw', encoding='utf-8')
+
+    def call(self, op, *args):
+        self.f.write(json.dumps({'op': op, 'args': args}) + '\n')
+        self.f.flush()
+        line = self.f.readline()
+        if not line:
+            raise TolinoException('tolinoclient daemon closed the connection.')
+        reply = json.loads(line)
+        if reply.get('error') is not None:
+            raise TolinoException(reply['error'])
+        return reply.get('result')
+
+    def __getattr__(self, name):
+        if name not in daemon_ops:
+            raise AttributeError(name)
+        return lambda *args: self.call(name, *args)
+
+    # the daemon may run in another directory
+
+    def upload(self, filename, name=None):
+        return self.call('upload', os.path.abspath(filename), name)
+
+    def add_cover(self, book_id, filename):
+        return self.call('add_cover', book_id, os.path.abspath(filename))
+
+    def download(self, path, id, filename=None, sha256=False):
+        return self.call('download', os.path.abspath(path or '.'), id, filename, sha256)
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+def listening(args):
+    # a RemoteCloud if a daemon is listening on the socket, whatever its
+    # account, None otherwise
+    path = expanduser(args.socket) if args.socket else None
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return RemoteCloud(path)
+    except OSError:
+        return None
+
+def daemon(args):
+    # a RemoteCloud if the daemon is listening on the socket and signed in
+    # to the account given by --user and --partner, None otherwise
+    remote = listening(args)
+    if remote is None:
+        return None
+    try:
+        account = remote.call('account')
+    except (TolinoException, OSError, ValueError):
+        account = None
+    if account is None or any(given is not None and given != account.get(key)
+                              for key, given in (('user', args.user), ('partner', args.partner))):
+        remote.close()
+        logging.warning('tolinoclient daemon on {} is signed in to another account, signing in instead.'.format(args.socket))
+        return None
+    return remote
+
+def login(args, register=True, pool_size=10):
     global confpath
-    c = TolinoCloud(args.partner, args.use_device, confpath)
+    token_cache = TokenCache(args.token_cache) if args.token_cache else None
+    c = TolinoCloud(args.partner, args.use_device, confpath, pool_size=pool_size, token_cache=token_cache)
     c.login(args.user, args.password)
-    c.register()
-    inv = c.inventory()
-    c.unregister()
+    if register:
+        c.register()
+    return c
+
+def connect(args, register=True):
+    c = daemon(args)
+    if c is not None:
+        return c
+    return login(args, register)
+
+def concurrent_session(args, jobs):
+    # For commands running calls in several threads: returns a function
+    # giving the cloud for the calling thread, and the local session to
+    # disconnect afterwards, None if the daemon does the work (one
+    # connection to it per thread).
+    remote = daemon(args)
+    if remote is None:
+        c = login(args, pool_size=jobs)
+        return (lambda: c), c
+    remote.close()
+    local = threading.local()
+    def cloud():
+        if not hasattr(local, 'c'):
+            local.c = RemoteCloud(expanduser(args.socket))
+        return local.c
+    return cloud, None
+
+def disconnect(c, args, unregister=True):
+    if isinstance(c, RemoteCloud):
+        c.close()
+        return
+    # with a token cache the session stays alive for the next call
+    if args.token_cache:
+        return
+    if unregister:
+        c.unregister()
     c.logout()
+
+def inventory(args):
+    c = connect(args)
+    inv = c.inventory()
+    disconnect(c, args)
     print('{} document{} stored in tolino cloud account {}'.format(len(inv), 's' if len(inv) > 1 else '', args.user))
     for i in inv:
         print('')
@@ -45,11 +167,9 @@ def inventory(args):
 
 
 def devices(args):
-    global confpath
-    c = TolinoCloud(args.partner, args.use_device, confpath)
-    c.login(args.user, args.password)
+    c = connect(args, register=False)
     devs = c.devices()
-    c.logout()
+    disconnect(c, args, unregister=False)
     print('{} device{} connected to tolino cloud account {}'.format(len(devs), 's' if len(devs) > 1 else '', args.user))
     for d in devs:
         print('')
@@ -61,75 +181,400 @@ def devices(args):
         print('last use  : {}'.format(datetime.datetime.fromtimestamp(d['lastusage']/1000.0).strftime('%c')))
 
 def unregister(args):
-    global confpath
-    c = TolinoCloud(args.partner, args.use_device, confpath)
-    c.login(args.user, args.password)
+    c = connect(args, register=False)
     c.unregister(args.device_id)
-    c.logout()
+    disconnect(c, args, unregister=False)
     print('unregistered device {} from tolino cloud.'.format(args.device_id))
 
 def upload(args):
-    global confpath
-    c = TolinoCloud(args.partner, args.use_device, confpath)
-    c.login(args.user, args.password)
-    c.register()
+    c = connect(args)
     document_id = c.upload(args.filename, args.name)
-    c.unregister()
-    c.logout()
+    disconnect(c, args)
     print('uploaded {} to tolino cloud as {}.'.format(args.filename, document_id))
 
+def upload_dir(args):
+    names = sorted(os.listdir(args.directory))
+    files = [os.path.join(args.directory, n) for n in names
+             if n.split('.')[-1].lower() in ('epub', 'pdf') and os.path.isfile(os.path.join(args.directory, n))]
+    if not files:
+        print('no .epub or .pdf files in {}.'.format(args.directory))
+        return
+    total = sum(os.path.getsize(fn) for fn in files)
+    cloud, c = concurrent_session(args, args.jobs)
+
+    lock = threading.Lock()
+    progress = {'files': 0, 'bytes': 0}
+    results = []
+
+    def sent(n):
+        with lock:
+            progress['bytes'] += n
+
+    def upload_one(fn):
+        try:
+            cl = cloud()
+            if isinstance(cl, RemoteCloud):
+                document_id = cl.upload(fn)
+                sent(os.path.getsize(fn))
+            else:
+                document_id = cl.upload(fn, progress=sent)
+            result = {'file': fn, 'ok': True, 'document_id': document_id}
+        except Exception as e:
+            result = {'file': fn, 'ok': False, 'error': str(e) or type(e).__name__}
+        with lock:
+            progress['files'] += 1
+            results.append(result)
+            status = 'uploaded as {}'.format(result['document_id']) if result['ok'] else 'FAILED: {}'.format(result['error'])
+            print('[{}/{} {:3.0f}%] {} {}'.format(progress['files'], len(files),
+                100.0 * min(progress['bytes'], total) / total if total else 100.0, fn, status))
+            sys.stdout.flush()
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        list(executor.map(upload_one, files))
+    if c is not None:
+        disconnect(c, args)
+
+    failed = [r for r in results if not r['ok']]
+    print('uploaded {} of {} files from {} to tolino cloud.'.format(len(files) - len(failed), len(files), args.directory))
+    if args.json:
+        with open(args.json, 'w') as f:
+            for r in sorted(results, key=lambda r: r['file']):
+                f.write(json.dumps(r) + '\n')
+    if failed:
+        sys.exit(1)
+
 def download(args):
-    global confpath
-    c = TolinoCloud(args.partner, args.use_device, confpath)
-    c.login(args.user, args.password)
-    c.register()
+    c = connect(args)
     fn = c.download(None, args.document_id)
-    c.unregister()
-    c.logout()
+    disconnect(c, args)
     print('downloaded {} from tolino cloud to {}.'.format(args.document_id, fn))
 
 def delete(args):
-    global confpath
-    c = TolinoCloud(args.partner, args.use_device, confpath)
-    c.login(args.user, args.password)
-    c.register()
+    c = connect(args)
     c.delete(args.document_id)
-    c.unregister()
-    c.logout()
+    disconnect(c, args)
     print('deleted {} from tolino cloud.'.format(args.document_id))
 
+def sync(args):
+    from tolinosync import sync as sync_dir
+    if not os.path.isdir(args.directory):
+        print('{} is not a directory.'.format(args.directory))
+        sys.exit(1)
+    cloud, c = concurrent_session(args, args.jobs)
+    results = sync_dir(cloud, args.directory, args.jobs, args.delete, args.dry_run)
+    if c is not None:
+        disconnect(c, args)
+
+    counts = {}
+    for r in results:
+        if r['status'] != 'unchanged':
+            counts[r['action']] = counts.get(r['action'], 0) + 1
+        if r['status'] == 'failed':
+            print('{} {}: FAILED: {}'.format(r['action'], r['file'], r['error']))
+        elif r['status'] != 'unchanged':
+            print('{}{} {}{}'.format('would ' if args.dry_run else '', r['action'], r['file'],
+                ' ({})'.format(r['document_id']) if r['document_id'] else ''))
+    failed = [r for r in results if r['status'] == 'failed']
+    if not counts:
+        print('{} and tolino cloud are in sync.'.format(args.directory))
+    else:
+        print('{}: {}{}.'.format(args.directory, ', '.join('{} {}'.format(n, a) for a, n in sorted(counts.items())),
+            ', {} failed'.format(len(failed)) if failed else ''))
+    if args.json:
+        with open(args.json, 'w') as f:
+            for r in results:
+                f.write(json.dumps(r) + '\n')
+    if failed:
+        sys.exit(1)
+
+def date_arg(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+def delete_bulk(args):
+    ids = list(args.document_ids)
+    if args.ids_from:
+        with (sys.stdin if args.ids_from == '-' else open(args.ids_from)) as f:
+            ids += [line.strip() for line in f if line.strip()]
+    filtered = bool(args.type or args.partner_id or args.mime or args.purchased_after or args.purchased_before)
+    if not ids and not filtered:
+        print('give document ids or a filter, refusing to delete everything.')
+        sys.exit(1)
+
+    c = daemon(args) or login(args, pool_size=args.jobs)
+    inv = c.inventory()
+    if filtered:
+        inv = select_inventory(inv, args.type, args.partner_id, args.mime, args.purchased_after, args.purchased_before)
+    known = dict((i['id'], i) for i in inv)
+    if ids:
+        # only the given ids, as far as they pass the filter
+        plan = [id for id in dict.fromkeys(ids) if id in known or not filtered]
+    else:
+        plan = list(known)
+
+    for id in plan:
+        i = known.get(id)
+        if i is None:
+            print('{}  (not in inventory)'.format(id))
+        else:
+            print('{}  {:5}  {:20}  {}  {}'.format(id, i['type'], i['mime'],
+                datetime.datetime.fromtimestamp(i['purchased']/1000.0).strftime('%Y-%m-%d'), i['title']))
+    print('{} document{} to delete.'.format(len(plan), '' if len(plan) == 1 else 's'))
+    if args.dry_run or not plan:
+        disconnect(c, args)
+        return
+    if not args.yes:
+        try:
+            answer = input('delete them? [y/N] ')
+        except EOFError:
+            answer = ''
+        if answer.strip().lower() not in ('y', 'yes'):
+            disconnect(c, args)
+            print('nothing deleted.')
+            return
+
+    results = c.bulk_delete(plan, args.jobs, args.rate)
+    disconnect(c, args)
+
+    failed = [r for r in results if r['status'] == 'failed']
+    for r in failed:
+        print('{}: FAILED: {}'.format(r['document_id'], r['error']))
+    print('deleted {} of {} documents from tolino cloud.'.format(len(results) - len(failed), len(results)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            for r in results:
+                f.write(json.dumps(r) + '\n')
+    if failed:
+        sys.exit(1)
+
 
 def meta(args):
-    global confpath
-    c = TolinoCloud(args.partner, args.use_device, confpath)
-    c.login(args.user, args.password)
-    c.register()
+    c = connect(args)
     if args.issued != None:
         datetime.datetime.strptime(args.issued, "%d.%m.%Y")
     c.metadata(args.document_id, args.title, args.subtitle, args.author, args.publisher, args.isbn, args.edition, args.issued, args.language)
-    c.unregister()
-    c.logout()
+    disconnect(c, args)
     print('successfully modified book {}'.format(args.document_id))
 
+def read_edits(filename):
+    # per-book edits from a CSV file with a header line (document_id and
+    # the fields to set, empty cells are left alone) or from JSON lines
+    with open(filename, newline='') as f:
+        if filename.lower().endswith('.csv'):
+            return [dict((k, v if v != '' else None) for k, v in row.items()) for row in csv.DictReader(f)]
+        return [json.loads(line) for line in f if line.strip()]
+
+def meta_bulk(args):
+    edits = read_edits(args.file)
+    unknown = set(k for e in edits for k in e) - set(TolinoCloud.metadata_fields) - {'document_id', 'id'}
+    if unknown:
+        print('unknown fields in {}: {}'.format(args.file, ', '.join(sorted(unknown))))
+        sys.exit(1)
+    c = daemon(args) or login(args, pool_size=args.jobs)
+    results = c.bulk_metadata(edits, args.jobs, args.dry_run)
+    disconnect(c, args)
+
+    counts = {}
+    for r in results:
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+        if r['status'] == 'failed':
+            print('{}: FAILED: {}'.format(r['document_id'], r['error']))
+        for field, (old, new) in sorted(r['changes'].items()):
+            print('{}: {}: {!r} -> {!r}'.format(r['document_id'], field, old, new))
+    print('{} books: {} {}, {} unchanged, {} failed.'.format(len(results),
+        counts.get('changed' if args.dry_run else 'updated', 0), 'to change' if args.dry_run else 'updated',
+        counts.get('unchanged', 0), counts.get('failed', 0)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            for r in results:
+                f.write(json.dumps(r) + '\n')
+    if counts.get('failed'):
+        sys.exit(1)
+
 def cover(args):
-    global confpath
-    c = TolinoCloud(args.partner, args.use_device, confpath)
-    c.login(args.user, args.password)
-    c.register()
-    c.cover(args.document_id, args.image)
-    c.unregister()
-    c.logout()
+    c = connect(args)
+    c.add_cover(args.document_id, args.image)
+    disconnect(c, args)
     print('successfully modified cover for book {}'.format(args.document_id))
 
 def add_to_collection(args):
-    global confpath
-    c = TolinoCloud(args.partner, args.use_device, confpath)
-    c.login(args.user, args.password)
-    c.register()
+    c = connect(args)
     c.add_to_collection(args.document_id, args.collection_name)
+    disconnect(c, args)
+    print('successfully modified collections for book {}'.format(args.document_id))
+
+def remove_from_collection(args):
+    c = connect(args)
+    c.remove_from_collection(args.document_id, args.collection_name)
+    disconnect(c, args)
+    print('successfully modified collections for book {}'.format(args.document_id))
+
+def collections_bulk(args):
+    ops = read_edits(args.file)
+    unknown = set(k for o in ops for k in o) - {'document_id', 'collection', 'collection_name', 'op'}
+    if unknown:
+        print('unknown fields in {}: {}'.format(args.file, ', '.join(sorted(unknown))))
+        sys.exit(1)
+    c = connect(args)
+    results = c.bulk_collections(ops, args.batch_size)
+    disconnect(c, args)
+
+    failed = [r for r in results if r['status'] == 'failed']
+    for r in failed:
+        print('{}: {} {}: FAILED: {}'.format(r['document_id'], r['op'], r['collection'], r['error']))
+    print('{} collection changes: {} done, {} failed.'.format(len(results), len(results) - len(failed), len(failed)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            for r in results:
+                f.write(json.dumps(r) + '\n')
+    if failed:
+        sys.exit(1)
+
+# operations of the batch subcommand: required fields and the call
+batch_ops = {
+    'upload'            : (('filename',), lambda c, o: {'document_id': c.upload(o['filename'], o.get('name'))}),
+    'download'          : (('document_id',), lambda c, o: {'filename': c.download(o.get('path'), o['document_id'])}),
+    'delete'            : (('document_id',), lambda c, o: c.delete(o['document_id'])),
+    'meta'              : (('document_id',), lambda c, o: c.metadata(o['document_id'], o.get('title'), o.get('subtitle'),
+                                                                     o.get('author'), o.get('publisher'), o.get('isbn'),
+                                                                     o.get('edition'), o.get('issued'), o.get('language'))),
+    'cover'             : (('document_id', 'image'), lambda c, o: c.add_cover(o['document_id'], o['image'])),
+    'add-to-collection' : (('document_id', 'collection_name'),
+                           lambda c, o: c.add_to_collection(o['document_id'], o['collection_name'])),
+    'remove-from-collection' : (('document_id', 'collection_name'),
+                                lambda c, o: c.remove_from_collection(o['document_id'], o['collection_name']))
+}
+
+def batch(args):
+    # Runs one operation per JSON line, e.g.
+    #   {"op": "delete", "document_id": "..."}
+    # and prints one JSON line per operation as soon as it is done, with
+    # the line number and the "id" of the operation, if it had one.
+    # Operations on different documents run concurrently, operations on
+    # the same document in the order they were given.
+    cloud, c = concurrent_session(args, args.jobs)
+    out_lock = threading.Lock()
+    failures = []
+
+    def report(result):
+        with out_lock:
+            print(json.dumps(result))
+            sys.stdout.flush()
+
+    def run(line_no, op, before):
+        if before is not None:
+            wait([before])
+        result = {'line': line_no, 'op': op.get('op')}
+        if 'id' in op:
+            result['id'] = op['id']
+        try:
+            if op.get('op') not in batch_ops:
+                raise TolinoException('unknown operation {}'.format(op.get('op')))
+            fields, call = batch_ops[op['op']]
+            missing = [field for field in fields if op.get(field) is None]
+            if missing:
+                raise TolinoException('missing {}'.format(', '.join(missing)))
+            result['result'] = call(cloud(), op)
+            result['ok'] = True
+        except Exception as e:
+            result['ok'] = False
+            result['error'] = str(e) or type(e).__name__
+        if not result['ok']:
+            failures.append(result)
+        report(result)
+
+    f = sys.stdin if args.file == '-' else open(args.file)
+    last = {}
+    with f, ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                op = json.loads(line)
+                if not isinstance(op, dict):
+                    raise ValueError('not an object')
+            except ValueError as e:
+                failures.append(line_no)
+                report({'line': line_no, 'ok': False, 'error': 'invalid JSON: {}'.format(e)})
+                continue
+            # the worker waits for the previous operation on the document;
+            # that one was queued earlier, so it is never stuck behind us
+            key = op.get('document_id')
+            future = executor.submit(run, line_no, op, last.get(key) if key else None)
+            if key:
+                last[key] = future
+
+    if c is not None:
+        disconnect(c, args)
+    if failures:
+        sys.exit(1)
+
+def logout(args):
+    c = connect(args, register=False)
+    if isinstance(c, RemoteCloud):
+        # the daemon unregisters and logs out when it stops
+        c.call('shutdown')
+        c.close()
+        print('stopped tolinoclient daemon.')
+        return
     c.unregister()
     c.logout()
-    print('successfully modified collections for book {}'.format(args.document_id))
+    print('logged out of tolino cloud.')
+
+class _DaemonHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            reply = {'result': None, 'error': None}
+            try:
+                request = json.loads(line)
+                op = request.get('op')
+                if op == 'shutdown':
+                    threading.Thread(target=self.server.shutdown).start()
+                elif op == 'account':
+                    # the clients only use a daemon of their own account
+                    reply['result'] = self.server.account
+                elif op in daemon_ops:
+                    reply['result'] = getattr(self.server.cloud, op)(*request.get('args', []))
+                else:
+                    reply['error'] = 'unknown call {}'.format(op)
+            except Exception as e:
+                reply['error'] = str(e) or type(e).__name__
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+def serve(args):
+    path = expanduser(args.socket)
+    remote = listening(args)
+    if remote is not None:
+        remote.close()
+        print('tolinoclient daemon is already listening on {}.'.format(path))
+        sys.exit(1)
+    if os.path.exists(path):
+        # left over from a daemon that did not stop cleanly
+        os.remove(path)
+    os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+
+    c = login(args)
+    old_umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, _DaemonHandler)
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    server.cloud = c
+    server.account = {'user': args.user, 'partner': args.partner}
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    print('tolinoclient daemon listening on {}.'.format(path))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        disconnect(c, args)
+    print('logged out of tolino cloud.')
 
 
 parser = argparse.ArgumentParser(
@@ -139,19 +584,22 @@ parser.add_argument('--config', metavar='FILE', default='~/.tolinoclientrc', hel
 args, remaining_argv = parser.parse_known_args()
 
 confpath = expanduser('~/.tolinoclientrc')
+conf = {}
 if args.config:
     confpath = expanduser(args.config)
     c = configparser.ConfigParser(strict=False, interpolation=None)
     c.read([expanduser(args.config)])
     if c.has_section('Defaults'):
-        defaults = dict(c.items('Defaults'))
-        parser.set_defaults(**defaults)
+        # 'token-cache = ...' and 'token_cache = ...' both set args.token_cache
+        conf = dict((key.replace('-', '_'), value) for key, value in c.items('Defaults'))
 
 parser.add_argument('--user', type=str, help='username (usually an email address)')
 parser.add_argument('--password', type=str, help='password')
 parser.add_argument('--partner', type=int, help='shop / partner id (use 0 for list)')
 parser.add_argument('--debug', action="store_true", help='log additional debugging info')
 parser.add_argument('--use-device', action="store_true", help='use existing device credentials instead of signing in')
+parser.add_argument('--token-cache', metavar='FILE', help='keep the session in FILE and reuse it in later calls, e.g. ~/.cache/tolinocloud/tokens.json')
+parser.add_argument('--socket', metavar='FILE', default='~/.cache/tolinocloud/tolinoclient.sock', help='Unix socket of the daemon started with "serve" (default: ~/.cache/tolinocloud/tolinoclient.sock)')
 
 subparsers = parser.add_subparsers()
 
@@ -163,6 +611,20 @@ s.add_argument('filename', metavar='FILE')
 s.add_argument('--name', help='specify an alternative name')
 s.set_defaults(func=upload)
 
+s = subparsers.add_parser('upload-dir', help='upload all .epub and .pdf files of a directory')
+s.add_argument('directory', metavar='DIR')
+s.add_argument('--jobs', type=int, default=4, help='number of files uploaded at the same time (default: 4)')
+s.add_argument('--json', metavar='FILE', help='write one JSON line per file with its document id or error to FILE')
+s.set_defaults(func=upload_dir)
+
+s = subparsers.add_parser('sync', help='two-way sync of the .epub and .pdf files of a directory with the uploads in the cloud')
+s.add_argument('directory', metavar='DIR')
+s.add_argument('--jobs', type=int, default=4, help='number of transfers at the same time (default: 4)')
+s.add_argument('--delete', action='store_true', help='delete files deleted on one side on the other side, too, instead of restoring them')
+s.add_argument('--dry-run', action='store_true', help='only show what would be done')
+s.add_argument('--json', metavar='FILE', help='write one JSON line per action with its result to FILE')
+s.set_defaults(func=sync)
+
 s = subparsers.add_parser('download', help='download a document')
 s.add_argument('document_id')
 s.set_defaults(func=download)
@@ -171,6 +633,21 @@ s = subparsers.add_parser('delete', help='delete a document (be careful!)')
 s.add_argument('document_id')
 s.set_defaults(func=delete)
 
+s = subparsers.add_parser('delete-bulk', help='delete many documents, given by id or by a filter on the inventory (be careful!)')
+s.add_argument('document_ids', metavar='DOCUMENT_ID', nargs='*')
+s.add_argument('--ids-from', metavar='FILE', help='read document ids from FILE, one per line (- for stdin)')
+s.add_argument('--type', action='append', default=[], choices=['edata', 'ebook'], help='only documents of this type (edata = uploads)')
+s.add_argument('--partner-id', action='append', default=[], type=int, help='only documents bought from this partner')
+s.add_argument('--mime', action='append', default=[], help='only documents of this format, e.g. pdf or application/epub+zip')
+s.add_argument('--purchased-after', type=date_arg, metavar='YYYY-MM-DD', help='only documents purchased or uploaded on or after this day')
+s.add_argument('--purchased-before', type=date_arg, metavar='YYYY-MM-DD', help='only documents purchased or uploaded before this day')
+s.add_argument('--dry-run', action='store_true', help='only show which documents would be deleted')
+s.add_argument('--yes', action='store_true', help='delete without asking')
+s.add_argument('--jobs', type=int, default=4, help='number of deletes at the same time (default: 4)')
+s.add_argument('--rate', type=float, default=0, help='at most this many deletes per second (default: unlimited)')
+s.add_argument('--json', metavar='FILE', help='write one JSON line per document with its result to FILE')
+s.set_defaults(func=delete_bulk)
+
 s = subparsers.add_parser('devices', help='list devices registered to cloud account')
 s.set_defaults(func=devices)
 
@@ -178,6 +655,17 @@ s = subparsers.add_parser('unregister', help='unregister device from cloud accou
 s.add_argument('device_id')
 s.set_defaults(func=unregister)
 
+s = subparsers.add_parser('batch', help='run the operations given as JSON lines in one session, print a JSON line per result')
+s.add_argument('file', metavar='FILE', nargs='?', default='-', help='operations, one JSON object per line (default: stdin)')
+s.add_argument('--jobs', type=int, default=4, help='number of operations run at the same time (default: 4)')
+s.set_defaults(func=batch)
+
+s = subparsers.add_parser('serve', help='keep a signed in session and carry out the calls of the other subcommands')
+s.set_defaults(func=serve)
+
+s = subparsers.add_parser('logout', help='end the session kept in the token cache or stop the daemon')
+s.set_defaults(func=logout)
+
 s = subparsers.add_parser('meta', help='set new meta data')
 s.add_argument('document_id')
 s.add_argument('--title', help='set a new title <string> eg. "Book Title 1"')
@@ -190,6 +678,13 @@ s.add_argument('--issued', help='set a new issued date <int> eg. "01.01.2019" ')
 s.add_argument('--language', help='set a new language <string> eg. "en"')
 s.set_defaults(func=meta)
 
+s = subparsers.add_parser('meta-bulk', help='set meta data of many books from a CSV or JSON lines file, writing only actual changes')
+s.add_argument('file', metavar='FILE', help='.csv with a document_id column and one column per field, or one JSON object per line')
+s.add_argument('--jobs', type=int, default=8, help='number of books handled at the same time (default: 8)')
+s.add_argument('--dry-run', action='store_true', help='only show the changes')
+s.add_argument('--json', metavar='FILE', help='write one JSON line per book with its status and changes to FILE')
+s.set_defaults(func=meta_bulk)
+
 s = subparsers.add_parser('cover', help='upload a cover for a specific book')
 s.add_argument('document_id')
 s.add_argument('image', metavar='IMAGE', help="must be a .png or .jpg")
@@ -200,6 +695,20 @@ s.add_argument('document_id')
 s.add_argument('collection_name')
 s.set_defaults(func=add_to_collection)
 
+s = subparsers.add_parser('remove-from-collection', help='remove a book from a collection')
+s.add_argument('document_id')
+s.add_argument('collection_name')
+s.set_defaults(func=remove_from_collection)
+
+s = subparsers.add_parser('collections-bulk', help='add books to or remove them from collections, many per request')
+s.add_argument('file', metavar='FILE', help='.csv with document_id, collection and optional op (add or remove) columns, or one JSON object per line')
+s.add_argument('--batch-size', type=int, default=TolinoCloud.collection_batch_size,
+               help='changes sent per request (default: {})'.format(TolinoCloud.collection_batch_size))
+s.add_argument('--json', metavar='FILE', help='write one JSON line per change with its status to FILE')
+s.set_defaults(func=collections_bulk)
+
+# after all add_argument() calls, their default= would win otherwise
+parser.set_defaults(**conf)
 args = parser.parse_args(remaining_argv)
 
 if args.debug:
@@ -211,7 +720,9 @@ if args.partner == 0:
         print('{} : {}'.format(partner_id, TolinoCloud.partner_name[partner_id]))
     sys.exit(1)
 
-if (not args.user) or (not args.password):
+# a running daemon has signed in already
+uses_daemon = args.socket and os.path.exists(expanduser(args.socket)) and getattr(args, 'func', None) is not serve
+if ((not args.user) or (not args.password)) and not uses_daemon:
     print('Login credentials user/password required.')
     parser.print_help()
     sys.exit(1)
@@ -33,13 +33,415 @@ import logging
 from pprint import pformat
 import time
 import sys
+import os
+import io
+import tempfile
+import calendar
+import datetime
+import hashlib
+import random
+import threading
+from email.utils import parsedate_to_datetime
 from configparser import ConfigParser
+from contextlib import contextmanager
 
 class TolinoException(Exception):
     pass
 
 
-class TolinoCloud:
+class TokenCache:
+
+    # Access and refresh tokens of earlier sessions, so a new process can
+    # skip the login. The file is only readable by the user, as its tokens
+    # grant access to the account just like the password.
+
+    def __init__(self, filename='~/.cache/tolinocloud/tokens.json'):
+        self.filename = os.path.expanduser(filename)
+        self.lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        with self.lock:
+            return self._read().get(key)
+
+    def put(self, key, entry):
+        # entry None removes the key. The accounts of a backup run in
+        # processes of their own, which share the file: the file lock keeps
+        # them from dropping each other's entries. get() needs no lock, the
+        # file is replaced as a whole.
+        os.makedirs(os.path.dirname(self.filename), mode=0o700, exist_ok=True)
+        with self.lock, _config_lock(self.filename):
+            tokens = self._read()
+            if entry is None:
+                tokens.pop(key, None)
+            else:
+                tokens[key] = entry
+            tmp = '{}.{}.tmp'.format(self.filename, os.getpid())
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(tokens, f)
+            os.replace(tmp, self.filename)
+
+
+@contextmanager
+def _config_lock(confpath):
+    # several processes (one per account) may update the same config
+    # or token cache file, serialize them with a lock file next to it
+    # (POSIX only)
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(confpath + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _preallocate(f, offset, length):
+    # Reserve disk space for the rest of the download, so the file system
+    # can place it in one piece. FALLOC_FL_KEEP_SIZE leaves the file size
+    # alone, which is what resuming a .part file relies on. Linux only,
+    # elsewhere (or if the file system refuses) this is a no-op.
+    if length <= 0 or not sys.platform.startswith('linux'):
+        return
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+        libc.fallocate(f.fileno(), 1, offset, length)
+    except (OSError, AttributeError):
+        pass
+
+
+class _JsonStream:
+
+    # Just enough of an incremental JSON reader to walk a large response
+    # without holding all of it: values are decoded one at a time with
+    # json's raw_decode as soon as the text chunks contain them completely.
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        # next non-whitespace character, '' at the end of the stream
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if c == '' or c not in chars:
+            raise ValueError('expected one of {!r} in JSON stream, got {!r}'.format(chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer might continue in the
+                # next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def members(self):
+        # keys of an object, the caller reads each value before
+        # asking for the next key
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def items(self):
+        # decoded elements of an array
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+class MultipartEncoder:
+
+    # multipart/form-data body that is read from the files while it is
+    # sent, instead of being built in memory. fields is a list of
+    # (name, value) for text fields and (name, (filename, path, mime)) for
+    # files. The length is known up front, so requests sends a
+    # Content-Length header. rewind() starts over, so the body can be sent
+    # again, e.g. after a 401; progress(n) is called with the number of
+    # bytes of every block read.
+
+    def __init__(self, fields, progress=None):
+        self.boundary = '----tolinocloud{:032x}'.format(random.getrandbits(128))
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+        self.progress = progress
+        self.parts = []
+        for name, value in fields:
+            if isinstance(value, tuple):
+                filename, path, mime = value
+                header = ('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                          'Content-Type: {}\r\n\r\n').format(self.boundary, name, filename.replace('"', '%22'), mime)
+                self.parts.append(header.encode('utf-8'))
+                self.parts.append(path)
+                self.parts.append(b'\r\n')
+            else:
+                self.parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+                    self.boundary, name, value).encode('utf-8'))
+        self.parts.append('--{}--\r\n'.format(self.boundary).encode('utf-8'))
+        self.length = sum(len(p) if isinstance(p, bytes) else os.path.getsize(p) for p in self.parts)
+        self.f = None
+        self.rewind()
+
+    def __len__(self):
+        return self.length
+
+    def rewind(self):
+        self.close()
+        self.part = 0
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        out = []
+        while size > 0 and self.part < len(self.parts):
+            p = self.parts[self.part]
+            if isinstance(p, bytes):
+                chunk = p[self.pos:self.pos + size]
+                self.pos += len(chunk)
+                done = self.pos >= len(p)
+            else:
+                if self.f is None:
+                    self.f = open(p, 'rb')
+                chunk = self.f.read(size)
+                done = not chunk
+                if done:
+                    self.close()
+            if chunk:
+                out.append(chunk)
+                size -= len(chunk)
+            if done:
+                self.part += 1
+                self.pos = 0
+        data = b''.join(out)
+        if data and self.progress is not None:
+            self.progress(len(data))
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(64 * 1024)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class _PartDigest:
+
+    # SHA-256 of a .part file, updated while the body is written to it
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.h = hashlib.sha256()
+        self.pos = 0
+
+    def sync(self, filename, offset):
+        # hash the bytes that are on disk already, e.g. when resuming a
+        # .part file from an earlier run
+        if self.pos > offset:
+            self.reset()
+        if self.pos == offset:
+            return
+        with open(filename, 'rb') as f:
+            f.seek(self.pos)
+            while self.pos < offset:
+                chunk = f.read(min(1024 * 1024, offset - self.pos))
+                if not chunk:
+                    break
+                self.update(chunk)
+
+    def update(self, data):
+        self.h.update(data)
+        self.pos += len(data)
+
+    def hexdigest(self):
+        return self.h.hexdigest()
+
+
+class AdaptiveLimit:
+
+    # AIMD limit on the number of parallel transfers: every successful
+    # transfer raises the limit a little (by one per round of `limit`
+    # transfers), every time the server pushes back it is halved. Bursts of
+    # rejections caused by the same congestion only halve it once.
+
+    def __init__(self, limit, minimum=1, maximum=None, cooldown=2.0):
+        self.minimum = minimum
+        self.maximum = maximum if maximum is not None else limit
+        self.limit = float(max(minimum, min(limit, self.maximum)))
+        self.cooldown = cooldown
+        self.active = 0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def increase(self):
+        with self.cond:
+            if self.limit < self.maximum:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                self.cond.notify_all()
+
+    def decrease(self):
+        with self.cond:
+            now = time.monotonic()
+            if now - self.last_decrease < self.cooldown:
+                return
+            self.last_decrease = now
+            limit = max(self.minimum, self.limit / 2)
+            if int(limit) < int(self.limit):
+                logging.info('server is throttling, reducing parallel transfers to {}.'.format(int(limit)))
+            self.limit = limit
+
+
+class BandwidthLimit:
+
+    # Token bucket shared by all transfers of a TolinoCloud. Every transfer
+    # reserves `quantum` bytes at a time before reading them; reservations
+    # are served in the order they were made, so concurrent transfers get
+    # an equal share of the bandwidth whatever their size.
+    #
+    # rate is in bytes per second, 0 means unlimited. windows is a list of
+    # (start, end, rate) with start and end in minutes after midnight
+    # (local time); the first window containing the current time wins,
+    # windows may wrap around midnight.
+
+    def __init__(self, rate, windows=(), quantum=64 * 1024, burst=None):
+        self.rate = rate
+        self.windows = list(windows)
+        self.quantum = quantum
+        self.burst = burst if burst is not None else quantum
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+
+    def current_rate(self):
+        if self.windows:
+            t = time.localtime()
+            minute = t.tm_hour * 60 + t.tm_min
+            for start, end, rate in self.windows:
+                if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                    return rate
+        return self.rate
+
+    def wait(self, n):
+        rate = self.current_rate()
+        if not rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            # unused bandwidth only accumulates up to one burst
+            start = max(self.next_free, now - self.burst / rate)
+            self.next_free = start + n / rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def _millis(t):
+    # datetime, date or milliseconds since the epoch as milliseconds
+    if isinstance(t, datetime.datetime):
+        return round(t.timestamp() * 1000)
+    if isinstance(t, datetime.date):
+        return round(time.mktime(t.timetuple()) * 1000)
+    return int(t)
+
+
+def select_inventory(inv, types=(), partners=(), mimes=(), purchased_after=None, purchased_before=None):
+    # The items of an inventory matching all given criteria; empty ones
+    # match everything. mimes are content formats ('application/pdf') or
+    # their short form ('pdf', 'epub'), purchased_after and _before are
+    # datetimes, dates or milliseconds since the epoch.
+    types = set(t.lower() for t in types)
+    partners = set(int(p) for p in partners)
+    mimes = set(m.lower() for m in mimes)
+    after = _millis(purchased_after) if purchased_after is not None else None
+    before = _millis(purchased_before) if purchased_before is not None else None
+
+    def matches(item):
+        mime = item['mime'].lower()
+        return ((not types or item['type'] in types) and
+                (not partners or item['partner'] in partners) and
+                (not mimes or mime in mimes or mime.split('/')[-1].split('+')[0] in mimes) and
+                (after is None or item['purchased'] >= after) and
+                (before is None or item['purchased'] < before))
+
+    return [item for item in inv if matches(item)]
+
+
+class TolinoCommon:
+
+    # What TolinoCloud and AsyncTolinoCloud share: the partner settings,
+    # the hardware id and the parsing of responses, none of which sends
+    # a request.
 
     def _hardware_id():
 
@@ -378,35 +780,331 @@ class TolinoCloud:
         }
     }
 
-    def __init__(self, partner_id, use_device=False, confpath='.tolinoclientrc', libpath=''):
+    def _debug(self, r):
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('-------------------- HTTP response --------------------')
+            logging.debug('status code: {}'.format(r.status_code))
+            logging.debug('cookies: {}'.format(pformat(r.cookies)))
+            logging.debug('headers: {}'.format(pformat(r.headers)))
+            try:
+                j = r.json()
+                logging.debug('json: {}'.format(pformat(j)))
+            except:
+                logging.debug('text: {}'.format(r.text))
+            logging.debug('-------------------------------------------------------')
+
+    def _save_device_token(self):
+        #Store new refresh token
+        with _config_lock(self.confpath):
+            config = ConfigParser()
+            config.read(self.confpath)
+            config.set(self.confsection, 'password', self.refresh_token)
+            with open(self.confpath, 'w') as f:
+                config.write(f)
+
+    def _parse_metadata(self, j):
+        try:
+            md = {
+                'partner'     : int(j['resellerId']),
+                'id'          : j['epubMetaData']['identifier'],
+                'title'       : j['epubMetaData']['title'],
+                'subtitle'    : j['epubMetaData']['subtitle'],
+                'author'      : [a['name'] for a in j['epubMetaData']['author']],
+                'mime'        : j['epubMetaData']['deliverable'][0]['contentFormat'],
+                'type'        : j['epubMetaData']['type'].lower(),
+                'purchased'   : int(j['epubMetaData']['deliverable'][0]['purchased'])
+            }
+            if j['epubMetaData']['issued']:
+                md['issued'] = int(j['epubMetaData']['issued'])
+            return md
+        except:
+            raise TolinoException('could not parse metadata')
+
+    def _parse_inventory(self, j):
+        try:
+            inv = []
+            # edata = own documents uploaded to Tolino Cloud
+            for item in j.get('edata') or []:
+                inv.append(self._parse_metadata(item))
+            # ebook = purchased ebooks in Tolino Cloud
+            for item in j.get('ebook') or []:
+                inv.append(self._parse_metadata(item))
+            return inv
+        except:
+            raise TolinoException('inventory list request failed.')
+
+    def _inventory_delta(self, j, revision, known_ids):
+        books = self._parse_inventory(j)
+        known_ids = set(known_ids)
+        return {
+            'revision' : j.get('revision'),
+            'full'     : self._inventory_full(j, revision),
+            'added'    : [b for b in books if b['id'] not in known_ids],
+            'changed'  : [b for b in books if b['id'] in known_ids],
+            'removed'  : self.inventory_removed(j, revision, known_ids, set(b['id'] for b in books))
+        }
+
+    def _inventory_full(self, j, revision):
+        return revision is None or j.get('revision') is None
+
+    def inventory_removed(self, j, revision, known_ids, ids):
+        # ids removed from the cloud according to an inventory (delta)
+        # j, or the info dict of iter_inventory(), that listed the books ids
+        if self._inventory_full(j, revision):
+            return [id for id in known_ids if id not in ids]
+        removed = []
+        for item in j.get('deleted') or []:
+            if isinstance(item, dict):
+                item = item.get('identifier') or item['epubMetaData']['identifier']
+            removed.append(item)
+        return removed
+
+    # fields of the upload metadata that can be edited
+    metadata_fields = ('title', 'subtitle', 'author', 'publisher', 'isbn', 'edition', 'issued', 'language')
+
+    def _metadata_value(self, field, value):
+        # the value as stored in the metadata
+        if field == 'edition':
+            return int(value)
+        if field == 'issued':
+            if isinstance(value, str):
+                value = datetime.datetime.strptime(value, '%d.%m.%Y')
+            return value.timestamp()
+        return str(value)
+
+    def metadata_changes(self, metadata, **fields):
+        # {field: (old, new)} for the given fields (None = keep) that
+        # differ from metadata
+        changes = {}
+        for field, value in fields.items():
+            if field not in self.metadata_fields:
+                raise TolinoException('unknown meta data field {}.'.format(field))
+            if value is None:
+                continue
+            value = self._metadata_value(field, value)
+            if metadata.get(field) != value:
+                changes[field] = (metadata.get(field), value)
+        return changes
+
+
+class TolinoCloud(TolinoCommon):
+
+    # (connect, read) timeout and number of resume attempts for downloads
+    download_timeout = (30, 120)
+    download_retries = 5
+    # bytes read from the connection at a time
+    download_buffer_size = 1024 * 1024
+
+    # prefetched download infos are used for at most this many seconds,
+    # or until shortly before their signed content url expires
+    download_info_ttl = 60
+    download_info_margin = 10
+
+    # access tokens are refreshed when they expire within this many seconds
+    token_refresh_margin = 60
+
+    # requests answered with one of these codes, and idempotent requests
+    # that failed to connect, are repeated after a jittered exponential
+    # backoff (or as long as a Retry-After header asks for). POST and
+    # PATCH requests may have been carried out despite a 5xx answer, they
+    # are only repeated after the codes in retry_status_unprocessed.
+    retry_status = (429, 500, 502, 503, 504)
+    retry_status_unprocessed = (429, 503)
+    idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+    retry_attempts = 5
+    retry_backoff = 0.5
+    retry_backoff_max = 30
+    retry_after_max = 300
+
+    def __init__(self, partner_id, use_device=False, confpath='.tolinoclientrc', libpath='', pool_size=10, token_cache=None, confsection='Defaults'):
         sys.path.append(libpath)
         import requests
+        from requests.adapters import HTTPAdapter
         self.partner_id = partner_id
         self.session = requests.session()
+        # one connection per concurrent request and host, otherwise
+        # urllib3 discards surplus connections and reconnects every time
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._download_info_cache = {}
+        self._download_info_lock = threading.Lock()
+        self.tracer = None
+        # an AdaptiveLimit to tell about throttling responses, if any
+        self.limiter = None
+        # a BandwidthLimit shared by all downloads, if any
+        self.bandwidth = None
+        self.token_cache = token_cache
+        self._token_lock = threading.Lock()
+        self.token_expires_at = None
+        self.registered = False
         self.use_device = use_device
         self.confpath = confpath
+        # config section the refresh token of a device is stored in
+        self.confsection = confsection
         if partner_id == 0:
             logging.info("Partner ID:")
             for key, value in self.partner_name.items():
                 logging.info(f"  - partner_id: {key}, name: {value}")
             raise SystemExit
 
-    def _debug(self, r):
-        if logging.getLogger().getEffectiveLevel() >= logging.DEBUG:
-            logging.debug('-------------------- HTTP response --------------------')
-            logging.debug('status code: {}'.format(r.status_code))
-            logging.debug('cookies: {}'.format(pformat(r.cookies)))
-            logging.debug('headers: {}'.format(pformat(r.headers)))
+    def set_tracer(self, tracer):
+        # see tolinotrace.py, None switches tracing off again
+        self.tracer = tracer
+        if tracer is not None:
+            tracer.install(self.session)
+
+    def _send(self, endpoint, method, url, **kwargs):
+        # endpoint is the name of the partner setting the url came from
+        if self.tracer is None:
+            return self.session.request(method, url, **kwargs)
+        return self.tracer.request(self.session, endpoint, method, url, **kwargs)
+
+    def _backoff(self, attempt, r=None):
+        # seconds to wait before the given retry attempt (1, 2, ...)
+        if r is not None and 'Retry-After' in r.headers:
+            value = r.headers['Retry-After']
             try:
-                j = r.json()
-                logging.debug('json: {}'.format(pformat(j)))
-            except:
-                logging.debug('text: {}'.format(r.text))
-            logging.debug('-------------------------------------------------------')
+                delay = float(value)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(value).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(0.0, delay), self.retry_after_max)
+        return random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * 2 ** attempt))
+
+    def _send_retrying(self, endpoint, method, url, **kwargs):
+        from requests.exceptions import ConnectionError, Timeout
+
+        attempt = 0
+        while True:
+            attempt += 1
+            # a MultipartEncoder body has been read by the last attempt
+            if isinstance(kwargs.get('data'), MultipartEncoder):
+                kwargs['data'].rewind()
+            try:
+                r = self._send(endpoint, method, url, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                if method not in self.idempotent_methods or attempt > self.retry_attempts:
+                    raise
+                delay = self._backoff(attempt)
+                logging.info('{} request failed ({}), retrying in {:.1f}s.'.format(endpoint, e, delay))
+                time.sleep(delay)
+                continue
+            if r.status_code not in self.retry_status:
+                return r
+            if r.status_code in (429, 503) and self.limiter is not None:
+                self.limiter.decrease()
+            if attempt > self.retry_attempts:
+                return r
+            if method not in self.idempotent_methods and r.status_code not in self.retry_status_unprocessed:
+                return r
+            delay = self._backoff(attempt, r)
+            logging.info('{} request answered {}, retrying in {:.1f}s.'.format(endpoint, r.status_code, delay))
+            r.close()
+            time.sleep(delay)
+
+    def _request(self, endpoint, method, url, **kwargs):
+        headers = kwargs.get('headers')
+        if headers is None or 't_auth_token' not in headers:
+            return self._send_retrying(endpoint, method, url, **kwargs)
+
+        self._ensure_token()
+        token = headers['t_auth_token'] = self.access_token
+        r = self._send_retrying(endpoint, method, url, **kwargs)
+        if r.status_code == 401 and self._can_refresh():
+            logging.info('access token rejected by {}, refreshing it.'.format(endpoint))
+            r.close()
+            self._refresh_rejected(token)
+            headers['t_auth_token'] = self.access_token
+            r = self._send_retrying(endpoint, method, url, **kwargs)
+        return r
+
+    def _can_refresh(self):
+        return 'token_url' in self.partner_settings[self.partner_id] and bool(getattr(self, 'refresh_token', None))
+
+    def _ensure_token(self):
+        # refresh the access token shortly before it expires; only one
+        # worker does so, the others wait for and use the new token
+        if self.token_expires_at is None or self.token_expires_at - self.token_refresh_margin > time.time():
+            return
+        with self._token_lock:
+            if self.token_expires_at - self.token_refresh_margin > time.time():
+                return
+            if self._can_refresh():
+                self.refresh()
+
+    def _refresh_rejected(self, token):
+        with self._token_lock:
+            # another worker may have refreshed it already
+            if self.access_token == token:
+                self.refresh()
+
+    def _token_request(self, data):
+        c = self.partner_settings[self.partner_id]
+
+        data = dict(data, client_id=c['client_id'], scope=c['scope'])
+        r = self._request('token', 'POST', c['token_url'], data=data, verify=True, allow_redirects=False)
+        self._debug(r)
+        try:
+            j = r.json()
+            self.access_token = j['access_token']
+            self.refresh_token = j['refresh_token']
+            self.token_expires = int(j['expires_in'])
+        except:
+            raise TolinoException('oauth access token request failed.')
+        self.token_expires_at = time.time() + self.token_expires
+
+    def refresh(self):
+        # fetch a new access token with the refresh token
+        c = self.partner_settings[self.partner_id]
+        if 'token_url' not in c or not getattr(self, 'refresh_token', None):
+            raise TolinoException('oauth token refresh not supported for {}.'.format(self.partner_name[self.partner_id]))
+        self._token_request({
+            'grant_type'   : 'refresh_token',
+            'refresh_token': self.refresh_token
+        })
+        if self.use_device:
+            self._save_device_token()
+        self._store_session()
+
+    def _cache_key(self):
+        return '{}:{}'.format(self.partner_id, self.username)
+
+    def _store_session(self):
+        if self.token_cache is None or self.use_device or self.token_expires_at is None:
+            return
+        self.token_cache.put(self._cache_key(), {
+            'access_token'  : self.access_token,
+            'refresh_token' : self.refresh_token,
+            'expires_at'    : self.token_expires_at,
+            'registered'    : self.registered
+        })
+
+    def _login_from_cache(self):
+        entry = self.token_cache.get(self._cache_key())
+        if entry is None:
+            return False
+        self.access_token = entry['access_token']
+        self.refresh_token = entry['refresh_token']
+        self.token_expires_at = entry['expires_at']
+        self.registered = entry['registered']
+        if self.token_expires_at - self.token_refresh_margin > time.time():
+            return True
+        try:
+            self.refresh()
+            return True
+        except TolinoException:
+            # refresh token expired or revoked as well
+            self.registered = False
+            return False
 
     def login(self, username, password):
         s = self.session
         c = self.partner_settings[self.partner_id]
+        self.username = username
 
         if self.use_device:
             TolinoCloud.hardware_id = username
@@ -414,32 +1112,20 @@ class TolinoCloud:
                 self.access_token = password
                 return
 
-            r = s.post(c['token_url'], data = {
-                'client_id'    : c['client_id'],
+            self._token_request({
                 'grant_type'   : 'refresh_token',
-                'refresh_token': password,
-                'scope'        : c['scope'],
-                }, verify=True, allow_redirects=False)
-            self._debug(r)
-            try:
-                j = r.json()
-                self.access_token = j['access_token']
-                self.refresh_token = j['refresh_token']
-                self.token_expires = int(j['expires_in'])
-                #Store new refresh token
-                config = ConfigParser()
-                config.read(self.confpath)
-                config.set('Defaults', 'password', self.refresh_token)
-                with open(self.confpath, 'w') as f:
-                    config.write(f)
-            except:
-                raise TolinoException('oauth access token request failed.')
+                'refresh_token': password
+            })
+            self._save_device_token()
+            return
+
+        if self.token_cache is not None and self._login_from_cache():
             return
 
         # Login with partner site
         # to retrieve site's cookies within browser session
         if 'login_form_url' in c:
-            r = s.get(c['login_form_url'], params = {
+            r = self._request('login_form', 'GET', c['login_form_url'], params = {
                 'client_id'     : c['client_id'],
                 'response_type' : 'code',
                 'scope'         : c['scope'],
@@ -447,10 +1133,10 @@ class TolinoCloud:
                 'x_buchde.skin_id': c['x_buchde.skin_id'],
                 'x_buchde.mandant_id' : c['x_buchde.mandant_id']
             }, verify=True, allow_redirects=False)
-        data = c['login_form']['extra']
+        data = dict(c['login_form']['extra'])
         data[c['login_form']['username']] = username
         data[c['login_form']['password']] = password
-        r = s.post(c['login_url'], data=data, verify=True)
+        r = self._request('login', 'POST', c['login_url'], data=data, verify=True)
         logging.debug(data)
         logging.debug(c['login_cookie'])
         self._debug(r)
@@ -460,7 +1146,7 @@ class TolinoCloud:
         auth_code = ""
         if 'tat_url' in c:
             try:
-                r = s.get(c['tat_url'], verify=True)
+                r = self._request('tat', 'GET', c['tat_url'], verify=True)
                 self._debug(r)
                 b64 = re.search(r'\&tat=(.*?)%3D', r.text).group(1)
                 self.access_token = base64.b64decode(b64+'==').decode('utf-8')
@@ -477,7 +1163,7 @@ class TolinoCloud:
             if 'login_form_url' in c:
                 params['x_buchde.skin_id'] = c['x_buchde.skin_id']
                 params['x_buchde.mandant_id'] = c['x_buchde.mandant_id']
-            r = s.get(c['auth_url'], params=params, verify=True, allow_redirects=False)
+            r = self._request('auth', 'GET', c['auth_url'], params=params, verify=True, allow_redirects=False)
             self._debug(r)
             try:
                 params = parse_qs(urlparse(r.headers['Location'].replace('#', '')).query)
@@ -486,30 +1172,23 @@ class TolinoCloud:
                 raise TolinoException('oauth code request failed.')
 
             # Fetch OAUTH access token
-            r = s.post(c['token_url'], data = {
-                'client_id'    : c['client_id'],
+            self._token_request({
                 'grant_type'   : 'authorization_code',
                 'code'         : auth_code,
-                'scope'        : c['scope'],
                 'redirect_uri' : c['reader_url']
-            }, verify=True, allow_redirects=False)
-            self._debug(r)
-            try:
-                j = r.json()
-                self.access_token = j['access_token']
-                self.refresh_token = j['refresh_token']
-                self.token_expires = int(j['expires_in'])
-            except:
-                raise TolinoException('oauth access token request failed.')
+            })
+            self._store_session()
 
     def logout(self):
         if self.use_device:
             return
-        s = self.session;
         c = self.partner_settings[self.partner_id]
 
+        if self.token_cache is not None:
+            self.token_cache.put(self._cache_key(), None)
+
         if 'revoke_url' in c:
-            r = s.post(c['revoke_url'],
+            r = self._request('revoke', 'POST', c['revoke_url'],
                 data = {
                     'client_id'  : c['client_id'],
                     'token_type' : 'refresh_token',
@@ -520,20 +1199,19 @@ class TolinoCloud:
             if r.status_code != 200:
                 raise TolinoException('logout failed.')
         else:
-            r = s.post(c['logout_url'])
+            r = self._request('logout', 'POST', c['logout_url'])
             self._debug(r)
             if r.status_code != 200:
                 raise TolinoException('logout failed.')
 
 
     def register(self):
-        if self.use_device:
+        if self.use_device or self.registered:
             return
-        s = self.session;
         c = self.partner_settings[self.partner_id]
 
         # Register our hardware
-        r = s.post(c['register_url'],
+        r = self._request('register', 'POST', c['register_url'],
               data = json.dumps({'hardware_name':'tolino sync reader'}),
               headers = {
                 'content-type': 'application/json',
@@ -548,14 +1226,15 @@ class TolinoCloud:
         self._debug(r)
         if r.status_code != 200:
             raise TolinoException('register {} failed.'.format(TolinoCloud.hardware_id))
+        self.registered = True
+        self._store_session()
 
-    def unregister(self, device_id = hardware_id):
+    def unregister(self, device_id = TolinoCommon.hardware_id):
         if self.use_device:
             return
-        s = self.session;
         c = self.partner_settings[self.partner_id]
 
-        r = s.post(c['unregister_url'],
+        r = self._request('unregister', 'POST', c['unregister_url'],
             data = json.dumps({
                 'deleteDevicesRequest':{
                     'accounts' : [ {
@@ -581,12 +1260,14 @@ class TolinoCloud:
                 raise TolinoException('unregister {} failed: {}'.format(device_id, j['ResponseInfo']['message']))
             except KeyError:
                 raise TolinoException('unregister {} failed: reason unknown.'.format(device_id))
+        if device_id == TolinoCloud.hardware_id:
+            self.registered = False
+            self._store_session()
 
     def devices(self):
-        s = self.session;
         c = self.partner_settings[self.partner_id]
 
-        r = s.post(c['devices_url'],
+        r = self._request('devices', 'POST', c['devices_url'],
             data = json.dumps({
                 'deviceListRequest':{
                     'accounts' : [ {
@@ -625,30 +1306,14 @@ class TolinoCloud:
         except:
             raise TolinoException('device list request failed.')
 
-    def _parse_metadata(self, j):
-        try:
-            md = {
-                'partner'     : int(j['resellerId']),
-                'id'          : j['epubMetaData']['identifier'],
-                'title'       : j['epubMetaData']['title'],
-                'subtitle'    : j['epubMetaData']['subtitle'],
-                'author'      : [a['name'] for a in j['epubMetaData']['author']],
-                'mime'        : j['epubMetaData']['deliverable'][0]['contentFormat'],
-                'type'        : j['epubMetaData']['type'].lower(),
-                'purchased'   : int(j['epubMetaData']['deliverable'][0]['purchased'])
-            }
-            if j['epubMetaData']['issued']:
-                md['issued'] = int(j['epubMetaData']['issued'])
-            return md
-        except:
-            raise TolinoException('could not parse metadata')
-
-    def inventory(self):
-        s = self.session;
+    def _inventory_request(self, revision=None):
         c = self.partner_settings[self.partner_id]
 
-        r = s.get(c['inventory_url'],
-            params = {'strip': 'true'},
+        params = {'strip': 'true'}
+        if revision is not None:
+            params['revision'] = revision
+        r = self._request('inventory', 'GET', c['inventory_url'],
+            params = params,
             headers = {
                 't_auth_token' : self.access_token,
                 'hardware_id'  : TolinoCloud.hardware_id,
@@ -658,22 +1323,96 @@ class TolinoCloud:
         self._debug(r)
         if r.status_code != 200:
             raise TolinoException('inventory list request failed.')
-
         try:
-            inv = []
-            j = r.json()
-            # edata = own documents uploaded to Tolino Cloud
-            for item in j['PublicationInventory']['edata']:
-                inv.append(self._parse_metadata(item))
-            # ebook = purchased ebooks in Tolino Cloud
-            for item in j['PublicationInventory']['ebook']:
-                inv.append(self._parse_metadata(item))
-            return inv
+            return r.json()['PublicationInventory']
         except:
             raise TolinoException('inventory list request failed.')
 
-    def upload(self, filename, name = None, ext = None):
-        s = self.session;
+    def inventory(self):
+        return list(self.iter_inventory())
+
+    def iter_inventory(self, revision=None, info=None, spool=False):
+        # Like inventory() (or inventory_delta() with a revision), but the
+        # response is parsed while it arrives and every book is yielded as
+        # soon as it is complete, with constant memory for any library
+        # size. The other members of the inventory ('revision', 'deleted')
+        # are stored into the info dict, they are complete once the
+        # generator is exhausted.
+        #
+        # With spool=True, the response is read into a temporary file
+        # first and parsed from there, so a caller consuming the books
+        # slowly does not keep the connection open (and idle) meanwhile.
+        c = self.partner_settings[self.partner_id]
+
+        params = {'strip': 'true'}
+        if revision is not None:
+            params['revision'] = revision
+        r = self._request('inventory', 'GET', c['inventory_url'],
+            params = params,
+            stream = True,
+            headers = {
+                't_auth_token' : self.access_token,
+                'hardware_id'  : TolinoCloud.hardware_id,
+                'reseller_id'  : str(self.partner_id)
+            }
+        )
+        if info is None:
+            info = {}
+        spooled = None
+        try:
+            if r.status_code != 200:
+                self._debug(r)
+                raise TolinoException('inventory list request failed.')
+            if r.encoding is None:
+                r.encoding = 'utf-8'
+            if spool:
+                spooled = tempfile.TemporaryFile()
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    spooled.write(chunk)
+                r.close()
+                spooled.seek(0)
+                text = io.TextIOWrapper(spooled, encoding=r.encoding)
+                chunks = iter(lambda: text.read(64 * 1024), '')
+            else:
+                chunks = r.iter_content(chunk_size=64 * 1024, decode_unicode=True)
+            stream = _JsonStream(chunks)
+            found = False
+            for key in stream.members():
+                if key != 'PublicationInventory':
+                    stream.value()
+                    continue
+                found = True
+                for key in stream.members():
+                    # edata = own documents uploaded to Tolino Cloud
+                    # ebook = purchased ebooks in Tolino Cloud
+                    if key in ('edata', 'ebook') and stream.peek() == '[':
+                        for item in stream.items():
+                            yield self._parse_metadata(item)
+                    else:
+                        info[key] = stream.value()
+            if not found:
+                raise TolinoException('inventory list request failed.')
+        except ValueError:
+            raise TolinoException('inventory list request failed.')
+        finally:
+            r.close()
+            if spooled is not None:
+                spooled.close()
+
+    def inventory_delta(self, revision=None, known_ids=()):
+        # Fetch the changes since the inventory revision of an earlier
+        # call, or the full inventory if revision is None. Returns the new
+        # revision and the added / changed books and removed ids, where
+        # known_ids are the ids the caller has seen so far.
+        #
+        # Hey, tolino developers: the web reader only ever asks for the
+        # full inventory. We send the revision of the last response back
+        # and treat 'deleted' as list of removed identifiers. If the server
+        # does not know about revisions, we simply get the full inventory.
+        return self._inventory_delta(self._inventory_request(revision), revision, known_ids)
+
+    def upload(self, filename, name = None, ext = None, progress = None):
+        # progress(n) is called for every block of n bytes sent
         c = self.partner_settings[self.partner_id]
 
         if name is None:
@@ -686,14 +1425,19 @@ class TolinoCloud:
             'epub' : 'application/epub+zip'
         }.get(ext.lower(), 'application/pdf')
 
-        r = s.post(c['upload_url'],
-            files = [('file', (name, open(filename, 'rb'), mime))],
-            headers = {
-                't_auth_token' : self.access_token,
-                'hardware_id'  : TolinoCloud.hardware_id,
-                'reseller_id'         : str(self.partner_id)
-            }
-        )
+        body = MultipartEncoder([('file', (name, filename, mime))], progress)
+        try:
+            r = self._request('upload', 'POST', c['upload_url'],
+                data = body,
+                headers = {
+                    'Content-Type' : body.content_type,
+                    't_auth_token' : self.access_token,
+                    'hardware_id'  : TolinoCloud.hardware_id,
+                    'reseller_id'         : str(self.partner_id)
+                }
+            )
+        finally:
+            body.close()
         self._debug(r)
         if r.status_code != 200:
             raise TolinoException('file upload failed.')
@@ -705,7 +1449,6 @@ class TolinoCloud:
             raise TolinoException('file upload failed.')
 
     def add_cover(self, book_id, filename, name = None, ext = None):
-        s = self.session;
         c = self.partner_settings[self.partner_id]
 
         if 'cover_url' not in c:
@@ -723,70 +1466,54 @@ class TolinoCloud:
             'jpg': 'image/jpeg'
         }.get(ext.lower(), 'application/jpeg')
 
-        r = s.post(c['cover_url'],
-            files = [('file', ('1092560016', open(filename, 'rb'), mime))],
-            data = {'deliverableId': book_id},
-            headers = {
-                't_auth_token' : self.access_token,
-                'hardware_id'  : TolinoCloud.hardware_id,
-                'reseller_id'         : str(self.partner_id)
-            }
-        )
+        body = MultipartEncoder([('deliverableId', book_id), ('file', ('1092560016', filename, mime))])
+        try:
+            r = self._request('cover', 'POST', c['cover_url'],
+                data = body,
+                headers = {
+                    'Content-Type' : body.content_type,
+                    't_auth_token' : self.access_token,
+                    'hardware_id'  : TolinoCloud.hardware_id,
+                    'reseller_id'         : str(self.partner_id)
+                }
+            )
+        finally:
+            body.close()
         self._debug(r)
         if r.status_code != 200:
             raise TolinoException('cover upload failed.')
 
     
-    def metadata(self, book_id, title=None, subtitle=None, author=None, publisher=None, isbn=None, edition=None,
-                issued=None, language=None):
-        s = self.session;
+    def _metadata_url(self, book_id):
         c = self.partner_settings[self.partner_id]
 
         if 'meta_url' not in c:
             raise TolinoException('no meta url defined for this provider.')
 
-        b = c['meta_url'] + '/?deliverableId={book_id}'.format(book_id=book_id)
-        r = s.get(b,
+        return c['meta_url'] + '/?deliverableId={book_id}'.format(book_id=book_id)
+
+    def get_metadata(self, book_id):
+        r = self._request('meta', 'GET', self._metadata_url(book_id),
                   headers={
                       't_auth_token': self.access_token,
                       'hardware_id': TolinoCloud.hardware_id,
                       'reseller_id': str(self.partner_id)
                   }
                   )
-
-        meta = r.json()
-
         self._debug(r)
+        if r.status_code != 200:
+            raise TolinoException('meta data request failed.')
+        try:
+            return r.json()['metadata']
+        except (KeyError, ValueError):
+            raise TolinoException('meta data request failed.')
 
-        if title is not None:
-            meta['metadata']['title'] = str(title)
-
-        if subtitle is not None:
-            meta['metadata']['subtitle'] = str(subtitle)
-
-        if author is not None:
-            meta['metadata']['author'] = str(author)
-
-        if publisher is not None:
-            meta['metadata']['publisher'] = str(publisher)
-
-        if isbn is not None:
-            meta['metadata']['isbn'] = str(isbn)
-
-        if edition is not None:
-            meta['metadata']['edition'] = int(edition)
-
-        if issued is not None:
-            meta['metadata']['issued'] = issued.timestamp()
-
-        if language is not None:
-            meta['metadata']['language'] = str(language)
-
+    def put_metadata(self, book_id, metadata):
         payload = {
-            'uploadMetaData': meta['metadata']
+            'uploadMetaData': metadata
         }
 
-        r = s.put(b,
+        r = self._request('meta', 'PUT', self._metadata_url(book_id),
                   data=json.dumps(payload),
                   headers={
                       'content-type': 'application/json',
@@ -799,37 +1526,97 @@ class TolinoCloud:
         if r.status_code != 200:
             raise TolinoException('meta data update failed.')
 
+    def metadata(self, book_id, title=None, subtitle=None, author=None, publisher=None, isbn=None, edition=None,
+                issued=None, language=None):
+        meta = self.get_metadata(book_id)
+        changes = self.metadata_changes(meta, title=title, subtitle=subtitle, author=author, publisher=publisher,
+                                        isbn=isbn, edition=edition, issued=issued, language=language)
+        # nothing to write if the book has these values already
+        if changes:
+            for field, (old, new) in changes.items():
+                meta[field] = new
+            self.put_metadata(book_id, meta)
+
         try:
-            return meta['metadata']['deliverableId']
+            return meta['deliverableId']
         except:
             raise TolinoException('meta data update failed.')
 
+    def bulk_metadata(self, edits, jobs=8, dry_run=False):
+        # Applies many edits, each a dict with 'document_id' (or 'id') and
+        # some of the metadata_fields. The current metadata of the books is fetched
+        # concurrently and only books with actual changes are written.
+        # Returns one result per edit, in order:
+        #   {'document_id', 'status', 'changes', 'error'}
+        # where status is 'updated', 'unchanged', 'failed' or, with
+        # dry_run, 'changed', and changes maps fields to [old, new].
+        from concurrent.futures import ThreadPoolExecutor
+        from requests.exceptions import RequestException
+
+        def apply(edit):
+            book_id = edit.get('document_id') or edit.get('id')
+            result = {'document_id': book_id, 'status': 'failed', 'changes': {}, 'error': None}
+            try:
+                if not book_id:
+                    raise TolinoException('document_id missing.')
+                fields = dict((k, v) for k, v in edit.items() if k not in ('document_id', 'id'))
+                meta = self.get_metadata(book_id)
+                changes = self.metadata_changes(meta, **fields)
+                result['changes'] = dict((field, list(change)) for field, change in changes.items())
+                if not changes:
+                    result['status'] = 'unchanged'
+                elif dry_run:
+                    result['status'] = 'changed'
+                else:
+                    for field, (old, new) in changes.items():
+                        meta[field] = new
+                    self.put_metadata(book_id, meta)
+                    result['status'] = 'updated'
+            except (TolinoException, RequestException, ValueError, TypeError) as e:
+                result['error'] = str(e) or type(e).__name__
+            return result
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            return list(executor.map(apply, edits))
+
+    # collection changes sent per sync-data request by bulk_collections
+    collection_batch_size = 200
+
+    def collection_patch(self, book_id, collection_name, op='add'):
+        # one sync-data patch adding the collection tag to a book or,
+        # with op='remove', taking it away
+        if op not in ('add', 'remove'):
+            raise TolinoException('unknown collection operation {}.'.format(op))
+        return {
+            "op":op,
+            "value":{
+                #"revision":None,
+                "modified":round(time.time() * 1000), #Milliseconds
+                "name":collection_name,
+                "category":"collection",
+                #"transientId":base64.b64encode(collection_name.encode('ascii')).decode('ascii') #was used in legacy web client
+            },
+            "path":"/publications/{book_id}/tags".format(book_id=book_id)
+        }
+
+    def sync_data(self, patches):
+        # sends a list of patches in a single PATCH request
+        r = self._sync_data_request(patches)
+        if r.status_code != 200:
+            raise TolinoException(self._sync_data_error(r))
 
-    def add_to_collection(self, book_id, collection_name):
-        s = self.session;
+    def _sync_data_request(self, patches):
         c = self.partner_settings[self.partner_id]
 
         if 'sync_data_url' not in c:
-            raise TolinoException('no meta url defined for this provider.')
+            raise TolinoException('no sync data url defined for this provider.')
 
         payload = {
             "revision":None,
-            "patches":[
-                {
-                    "op":"add",
-                    "value":{
-                        #"revision":None,
-                        "modified":round(time.time() * 1000), #Milliseconds
-                        "name":collection_name,
-                        "category":"collection",
-                        #"transientId":base64.b64encode(collection_name.encode('ascii')).decode('ascii') #was used in legacy web client
-                    },
-                    "path":"/publications/{book_id}/tags".format(book_id=book_id)
-                }
-            ]
+            "patches":patches
         }
 
-        r = s.patch(c['sync_data_url'],
+        r = self._request('sync_data', 'PATCH', c['sync_data_url'],
                     data=json.dumps(payload),
                     headers={
                         'content-type': 'application/json',
@@ -840,15 +1627,82 @@ class TolinoCloud:
                     }
                 )
         self._debug(r)
-        if r.status_code != 200:
-            raise TolinoException('collection update failed.')
+        return r
+
+    def _sync_data_error(self, r):
+        try:
+            message = r.json()['ResponseInfo']['message']
+        except (ValueError, KeyError, TypeError):
+            message = 'HTTP {}'.format(r.status_code)
+        return 'collection update failed: {}'.format(message)
+
+    def add_to_collection(self, book_id, collection_name):
+        self.sync_data([self.collection_patch(book_id, collection_name)])
+
+    def remove_from_collection(self, book_id, collection_name):
+        self.sync_data([self.collection_patch(book_id, collection_name, 'remove')])
+
+    def bulk_collections(self, ops, batch_size=None):
+        # Applies many collection changes, each a dict with 'document_id',
+        # 'collection' and optionally 'op' ('add', the default, or
+        # 'remove'), with batch_size patches per PATCH request.
+        # A request rejected as invalid (4xx) is split in halves and sent
+        # again until the patches at fault are found, so one bad book costs
+        # a few more requests instead of failing its whole batch. Network,
+        # server (5xx) and authorization errors fail the whole batch.
+        # Returns one result per op, in order:
+        #   {'document_id', 'collection', 'op', 'status', 'error'}
+        # where status is 'ok' or 'failed'.
+        from requests.exceptions import RequestException
+
+        batch_size = max(1, batch_size or self.collection_batch_size)
+        results = []
+        pending = []
+        for op in ops:
+            book_id = op.get('document_id')
+            name = op.get('collection') or op.get('collection_name')
+            result = {'document_id': book_id, 'collection': name, 'op': op.get('op') or 'add',
+                      'status': 'failed', 'error': None}
+            results.append(result)
+            try:
+                if not book_id:
+                    raise TolinoException('document_id missing.')
+                if not name:
+                    raise TolinoException('collection missing.')
+                pending.append((result, self.collection_patch(book_id, name, result['op'])))
+            except TolinoException as e:
+                result['error'] = str(e)
+
+        def fail(batch, error):
+            for result, patch in batch:
+                result['error'] = error
+
+        def send(batch):
+            try:
+                r = self._sync_data_request([patch for result, patch in batch])
+            except (TolinoException, RequestException) as e:
+                fail(batch, str(e) or type(e).__name__)
+                return
+            if r.status_code == 200:
+                for result, patch in batch:
+                    result['status'] = 'ok'
+            elif 400 <= r.status_code < 500 and r.status_code not in (401, 403, 408, 429) and len(batch) > 1:
+                # some patch is at fault, find it
+                half = len(batch) // 2
+                send(batch[:half])
+                send(batch[half:])
+            else:
+                fail(batch, self._sync_data_error(r))
+
+        for n in range(0, len(pending), batch_size):
+            send(pending[n:n + batch_size])
+        return results
 
 
     def delete(self, id):
-        s = self.session;
         c = self.partner_settings[self.partner_id]
 
-        r = s.get(c['delete_url'],
+        r = self._request('delete', 'GET', c['delete_url'],
             params = {
                 'deliverableId': id
             },
@@ -863,15 +1717,38 @@ class TolinoCloud:
             try:
                 j = r.json()
                 raise TolinoException('delete {} failed: {}'.format(id, j['ResponseInfo']['message']))
-            except KeyError:
+            except (KeyError, ValueError, TypeError):
                 raise TolinoException('delete {} failed: reason unknown.'.format(id))
 
+    def bulk_delete(self, ids, jobs=4, rate=0):
+        # Deletes many documents, jobs at a time and at most rate deletes
+        # per second (0 = unlimited). Returns one result per id, in order:
+        #   {'document_id', 'status', 'error'}
+        # where status is 'deleted' or 'failed'.
+        from concurrent.futures import ThreadPoolExecutor
+        from requests.exceptions import RequestException
+
+        # a token bucket of requests instead of bytes
+        limit = BandwidthLimit(rate, quantum=1)
+
+        def delete_one(book_id):
+            result = {'document_id': book_id, 'status': 'failed', 'error': None}
+            try:
+                limit.wait(1)
+                self.delete(book_id)
+                result['status'] = 'deleted'
+            except (TolinoException, RequestException) as e:
+                result['error'] = str(e) or type(e).__name__
+            return result
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            return list(executor.map(delete_one, ids))
+
     def download_info(self, id):
-        s = self.session;
         c = self.partner_settings[self.partner_id]
 
         b64 = base64.b64encode(bytes(id, 'utf-8')).decode('utf-8')
-        r = s.get(c['downloadinfo_url'].format(b64, b64),
+        r = self._request('downloadinfo', 'GET', c['downloadinfo_url'].format(b64, b64),
             headers = {
                 't_auth_token' : self.access_token,
                 'hardware_id'  : TolinoCloud.hardware_id,
@@ -890,37 +1767,173 @@ class TolinoCloud:
             'filetype' : j['DownloadInfo']['format'],
         }
 
-    def download(self, path, id):
-        s = self.session;
-        c = self.partner_settings[self.partner_id]
-
+    def _url_expires(self, url):
+        # signed content urls usually carry their expiry in the query
+        q = parse_qs(urlparse(url).query)
+        try:
+            if 'Expires' in q:
+                return int(q['Expires'][0])
+            if 'X-Amz-Date' in q and 'X-Amz-Expires' in q:
+                signed = calendar.timegm(time.strptime(q['X-Amz-Date'][0], '%Y%m%dT%H%M%SZ'))
+                return signed + int(q['X-Amz-Expires'][0])
+        except ValueError:
+            pass
+        return None
+
+    def prefetch_download_info(self, id):
         di = self.download_info(id)
-
-        r = s.get(di['url'],
-            stream=True,
+        expires = time.time() + self.download_info_ttl
+        url_expires = self._url_expires(di['url'])
+        if url_expires is not None:
+            expires = min(expires, url_expires - self.download_info_margin)
+        with self._download_info_lock:
+            self._download_info_cache[id] = (expires, di)
+        return di
+
+    def _cached_download_info(self, id):
+        with self._download_info_lock:
+            expires, di = self._download_info_cache.pop(id, (0, None))
+        if time.time() < expires:
+            return di
+        return None
+
+    def download(self, path, id, filename=None, sha256=False):
+        # returns the file name, with sha256=True the file name and the
+        # SHA-256 hex digest of its content, computed while downloading
+        from requests.exceptions import RequestException
+        from urllib3.exceptions import HTTPError as TransportError
+
+        di = self._cached_download_info(id)
+        cached = di is not None
+        if not cached:
+            di = self.download_info(id)
+
+        if filename is None:
+            filename = di['filename']
+        if path:
+            filename = path + '/' + filename
+
+        # The body is streamed into a .part file which is only renamed to
+        # its final name once it is complete. After a network error (or
+        # when a previous run was interrupted) the transfer continues with
+        # a range request where the .part file ends.
+        part_filename = filename + '.part'
+        digest = _PartDigest() if sha256 else None
+        retries = 0
+        while True:
+            offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
             headers = {
                 't_auth_token' : self.access_token,
                 'hardware_id'  : TolinoCloud.hardware_id,
                 'reseller_id'  : str(self.partner_id)
             }
-        )
-        self._debug(r)
-        if r.status_code != 200:
+            if offset > 0:
+                headers['Range'] = 'bytes={}-'.format(offset)
+            try:
+                r = self._request('content', 'GET', di['url'], stream=True, headers=headers, timeout=self.download_timeout)
+                if cached and r.status_code in (401, 403, 404, 410):
+                    # the prefetched content url was rejected, fetch a new one
+                    r.close()
+                    cached = False
+                    di = self.download_info(id)
+                    continue
+                try:
+                    size = self._write_part(r, part_filename, offset, digest)
+                finally:
+                    r.close()
+            except (RequestException, TransportError) as e:
+                retries += 1
+                if retries > self.download_retries:
+                    raise TolinoException('download request failed: {}'.format(e))
+                logging.info('download of {} interrupted ({}), resuming.'.format(id, e))
+                time.sleep(self._backoff(retries))
+                continue
+
+            if size is not None:
+                os.replace(part_filename, filename)
+                if digest is None:
+                    return filename
+                digest.sync(filename, size)
+                return filename, digest.hexdigest()
+
+            # size mismatch, the connection was closed early
+            retries += 1
+            if retries > self.download_retries:
+                raise TolinoException('download request failed: incomplete transfer.')
+            logging.info('download of {} incomplete, resuming.'.format(id))
+            time.sleep(self._backoff(retries))
+
+    def _write_part(self, r, part_filename, offset, digest=None):
+        # returns the size of the complete file or None if the transfer
+        # ended before all bytes arrived; digest (a _PartDigest) is fed
+        # with everything written
+        if r.status_code == 416 and offset > 0:
+            # nothing left to fetch if the .part file already has all bytes
+            m = re.match(r'bytes \*/(\d+)', r.headers.get('Content-Range', ''))
+            if m and int(m.group(1)) == offset:
+                return offset
+            os.remove(part_filename)
+            return None
+        if r.status_code == 206:
+            m = re.match(r'bytes (\d+)-\d+/(\d+|\*)', r.headers.get('Content-Range', ''))
+            if not m or int(m.group(1)) != offset:
+                raise TolinoException('download request failed: unexpected content range.')
+            total = int(m.group(2)) if m.group(2) != '*' else None
+            mode = 'ab'
+        elif r.status_code == 200:
+            # range not supported, start over
+            offset = 0
+            total = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+            mode = 'wb'
+        else:
+            self._debug(r)
             try:
                 j = r.json()
                 raise TolinoException('download request failed: {}'.format(j['ResponseInfo']['message']))
-            except KeyError:
+            except (KeyError, ValueError):
                 raise TolinoException('download request : reason unknown.')
 
-
-        filename = path + '/' + di['filename'] if path else di['filename']
-        with open(filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
+        if digest is not None:
+            digest.sync(part_filename, offset)
+        with open(part_filename, mode) as f:
+            if r.headers.get('Content-Encoding', 'identity') != 'identity':
+                # compressed transfer, the length refers to the encoded body
+                total = None
+                bandwidth = self.bandwidth
+                chunk_size = self.download_buffer_size if bandwidth is None else min(self.download_buffer_size, bandwidth.quantum)
+                for chunk in r.iter_content(chunk_size=chunk_size):
                     f.write(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+                    if bandwidth is not None:
+                        bandwidth.wait(len(chunk))
+            else:
+                if total is not None:
+                    _preallocate(f, offset, total - offset)
+                # large reads from the raw stream keep the per-chunk
+                # overhead of the Python loop low
+                read = r.raw.read
+                write = f.write
+                chunk_size = self.download_buffer_size
+                bandwidth = self.bandwidth
+                if bandwidth is not None:
+                    # small reads, so the limit is shared out evenly
+                    chunk_size = min(chunk_size, bandwidth.quantum)
+                while True:
+                    if bandwidth is not None:
+                        bandwidth.wait(chunk_size)
+                    chunk = read(chunk_size)
+                    if not chunk:
+                        break
+                    write(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
             f.flush()
+            size = f.tell()
 
-        return filename
+        if total is not None and size != total:
+            return None
+        return size
 
     def set_token(self, token):
         self.access_token = token
@@ -0,0 +1,212 @@
+#metrics of backup runs, as Prometheus textfile or JSON
+
+# RunMetrics collects the numbers of one backup run of one account:
+#
+#   items    : books by outcome (downloaded, skipped, failed)
+#   bytes    : bytes transferred
+#   phases   : seconds spent and calls per phase (login, register,
+#              inventory, plan, download_info, transfer, finalize);
+#              download_info, transfer and finalize add up the time of
+#              all their items, so they may exceed the run duration
+#   histograms of the download info and transfer latencies and of the
+#   throughput of every transfer
+#
+# Several runs (one per account) are written to one file, either in the
+# text format of the Prometheus node exporter's textfile collector or as
+# JSON. Both are replaced atomically, so a scrape never sees half a file.
+#
+#   write_prometheus('/var/lib/node_exporter/tolino.prom', [metrics.to_dict()])
+
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from time import perf_counter
+
+PHASES = ('login', 'register', 'inventory', 'plan', 'download_info', 'transfer', 'finalize')
+OUTCOMES = ('downloaded', 'skipped', 'failed')
+
+# upper bounds of the histogram buckets, +Inf is added
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+THROUGHPUT_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        n = 0
+        while n < len(self.buckets) and value > self.buckets[n]:
+            n += 1
+        self.counts[n] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        # cumulative counts, as in Prometheus
+        cumulative = []
+        total = 0
+        for n in self.counts:
+            total += n
+            cumulative.append(total)
+        return {
+            'buckets' : [[le, n] for le, n in zip(list(self.buckets) + ['+Inf'], cumulative)],
+            'sum'     : self.sum,
+            'count'   : self.count
+        }
+
+
+class RunMetrics:
+
+    def __init__(self, account):
+        self.account = account
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.t0 = perf_counter()
+        self.duration = None
+        self.error = None
+        self.items = dict((outcome, 0) for outcome in OUTCOMES)
+        self.bytes = 0
+        self.phases = dict((phase, [0.0, 0]) for phase in PHASES)
+        self.histograms = {
+            'download_info_seconds'                 : Histogram(LATENCY_BUCKETS),
+            'transfer_seconds'                      : Histogram(LATENCY_BUCKETS),
+            'transfer_throughput_bytes_per_second'  : Histogram(THROUGHPUT_BUCKETS)
+        }
+
+    def add_phase(self, phase, seconds, calls=1):
+        with self.lock:
+            self.phases[phase][0] += seconds
+            self.phases[phase][1] += calls
+
+    @contextmanager
+    def phase(self, phase):
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, perf_counter() - t0)
+
+    def download_info(self, seconds):
+        with self.lock:
+            self.phases['download_info'][0] += seconds
+            self.phases['download_info'][1] += 1
+            self.histograms['download_info_seconds'].observe(seconds)
+
+    def transfer(self, seconds, nbytes):
+        with self.lock:
+            self.phases['transfer'][0] += seconds
+            self.phases['transfer'][1] += 1
+            self.bytes += nbytes
+            self.histograms['transfer_seconds'].observe(seconds)
+            if seconds > 0:
+                self.histograms['transfer_throughput_bytes_per_second'].observe(nbytes / seconds)
+
+    def set_items(self, outcome, n):
+        with self.lock:
+            self.items[outcome] = n
+
+    def finish(self, error=None):
+        with self.lock:
+            self.duration = perf_counter() - self.t0
+            self.error = error
+
+    def to_dict(self):
+        with self.lock:
+            duration = self.duration if self.duration is not None else perf_counter() - self.t0
+            return {
+                'account'    : self.account,
+                'started'    : self.started,
+                'duration'   : duration,
+                'success'    : self.error is None and self.items['failed'] == 0,
+                'error'      : self.error,
+                'items'      : dict(self.items),
+                'bytes'      : self.bytes,
+                'throughput' : self.bytes / duration if duration > 0 else 0.0,
+                'phases'     : dict((phase, {'seconds': seconds, 'calls': calls})
+                                    for phase, (seconds, calls) in self.phases.items()),
+                'histograms' : dict((name, h.to_dict()) for name, h in self.histograms.items())
+            }
+
+
+def _replace(filename, text):
+    # write to a temporary file next to filename, then rename it
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, filename)
+
+
+def write_json(filename, runs):
+    _replace(filename, json.dumps({'runs': runs}, indent=2) + '\n')
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels.items()) + '}'
+
+
+def prometheus_text(runs):
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append('# HELP tolino_backup_{} {}'.format(name, help))
+        lines.append('# TYPE tolino_backup_{} {}'.format(name, kind))
+        for suffix, labels, value in samples:
+            lines.append('tolino_backup_{}{}{} {}'.format(name, suffix, _labels(**labels), repr(float(value))))
+
+    metric('success', 'gauge', 'Whether the last run completed without failures.',
+           [('', {'account': r['account']}, 1 if r['success'] else 0) for r in runs])
+    metric('last_run_timestamp_seconds', 'gauge', 'Start of the last run.',
+           [('', {'account': r['account']}, r['started']) for r in runs])
+    metric('duration_seconds', 'gauge', 'Duration of the last run.',
+           [('', {'account': r['account']}, r['duration']) for r in runs])
+    metric('items', 'gauge', 'Books of the last run by outcome.',
+           [('', {'account': r['account'], 'outcome': outcome}, n) for r in runs for outcome, n in r['items'].items()])
+    metric('bytes', 'gauge', 'Bytes transferred in the last run.',
+           [('', {'account': r['account']}, r['bytes']) for r in runs])
+    metric('throughput_bytes_per_second', 'gauge', 'Bytes transferred per second of the last run.',
+           [('', {'account': r['account']}, r['throughput']) for r in runs])
+    metric('phase_seconds', 'gauge', 'Seconds spent per phase in the last run, summed over all items.',
+           [('', {'account': r['account'], 'phase': phase}, p['seconds']) for r in runs for phase, p in r['phases'].items()])
+    metric('phase_calls', 'gauge', 'Calls per phase in the last run.',
+           [('', {'account': r['account'], 'phase': phase}, p['calls']) for r in runs for phase, p in r['phases'].items()])
+
+    helps = {
+        'download_info_seconds'                : 'Latency of the download info requests of the last run.',
+        'transfer_seconds'                     : 'Duration of the book transfers of the last run.',
+        'transfer_throughput_bytes_per_second' : 'Throughput of the book transfers of the last run.'
+    }
+    for name, help in helps.items():
+        samples = []
+        for r in runs:
+            h = r['histograms'][name]
+            for le, n in h['buckets']:
+                samples.append(('_bucket', {'account': r['account'], 'le': le}, n))
+            samples.append(('_sum', {'account': r['account']}, h['sum']))
+            samples.append(('_count', {'account': r['account']}, h['count']))
+        metric(name, 'histogram', help, samples)
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(filename, runs):
+    _replace(filename, prometheus_text(runs))
@@ -0,0 +1,233 @@
+#two-way sync between a local directory and the tolino cloud uploads
+
+# Keeps the .epub and .pdf files of a directory and the user storage
+# area (the 'edata' documents) of a tolino cloud account in step: new
+# local files are uploaded and new cloud documents downloaded. A file
+# deleted on one side is restored from the other one, or, with
+# delete=True, deleted there as well.
+#
+# A small SQLite index within the directory remembers document id, size,
+# mtime and SHA-256 of every synced file. Files whose size and mtime
+# match the index are unchanged without reading them, so a sync with
+# nothing to do costs one inventory request and a directory listing.
+# Only files with a new mtime are hashed, and uploaded again if their
+# content did change.
+#
+# On the first sync, a local file and a cloud document with the same
+# name (title and format) are taken to be the same, so an existing copy
+# of the uploads is neither uploaded nor downloaded again.
+#
+#   results = sync(lambda: c, 'books')
+
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from manifest import sha256_file
+
+SYNC_INDEX_FILENAME = '.tolino-sync.sqlite'
+
+file_extensions = {
+    'application/epub+zip' : 'epub',
+    'application/pdf'      : 'pdf'
+}
+
+
+class SyncIndex:
+
+    columns = ('path', 'id', 'size', 'mtime_ns', 'sha256')
+
+    def __init__(self, filename):
+        # the connection is shared by all sync workers
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    path     TEXT PRIMARY KEY,
+                    id       TEXT NOT NULL,
+                    size     INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256   TEXT NOT NULL
+                )''')
+
+    def entries(self):
+        # {path: entry} of all synced files
+        with self.lock:
+            rows = self.db.execute('SELECT {} FROM files'.format(', '.join(self.columns))).fetchall()
+        return dict((row[0], dict(zip(self.columns, row))) for row in rows)
+
+    def put(self, path, id, size, mtime_ns, sha256):
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO files ({}) VALUES (?, ?, ?, ?, ?)'.format(', '.join(self.columns)),
+                (path, id, size, mtime_ns, sha256))
+
+    def remove(self, path):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def scan(directory):
+    # {file name: (size, mtime_ns)} of the books in directory, from
+    # their directory entries only
+    local = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            if entry.name.split('.')[-1].lower() not in file_extensions.values():
+                continue
+            st = entry.stat()
+            local[entry.name] = (st.st_size, st.st_mtime_ns)
+    return local
+
+
+def local_name(item):
+    # file name of a cloud document, uploads get the name of their file
+    # without extension as title
+    title = re.sub(r'[/\\\x00]', '_', item['title'] or '').strip().lstrip('.') or item['id']
+    return '{}.{}'.format(title, file_extensions.get(item['mime'], 'pdf'))
+
+
+def _unique_name(name, taken):
+    stem, ext = name.rsplit('.', 1)
+    n = 2
+    while name in taken:
+        name = '{} ({}).{}'.format(stem, n, ext)
+        n += 1
+    taken.add(name)
+    return name
+
+
+def plan_sync(local, index, cloud, delete=False):
+    # The actions to bring directory and cloud in step, as a list of
+    # (action, file name, document id):
+    #   upload, download, link (same file on both sides, index it),
+    #   check (mtime changed: hash, upload again if the content did),
+    #   delete-local, delete-cloud, forget (gone on both sides)
+    # local is from scan(), index from SyncIndex.entries() and cloud maps
+    # the ids of the 'edata' documents to their inventory items.
+    actions = []
+    indexed_ids = set(entry['id'] for entry in index.values())
+    for name, entry in sorted(index.items()):
+        id = entry['id']
+        here = name in local
+        there = id in cloud
+        changed = here and local[name] != (entry['size'], entry['mtime_ns'])
+        if here and there:
+            if changed:
+                actions.append(('check', name, id))
+        elif here:
+            # gone from the cloud; local changes win over the delete
+            actions.append(('delete-local' if delete and not changed else 'upload', name, None))
+        elif there:
+            actions.append(('delete-cloud' if delete else 'download', name, id))
+        else:
+            actions.append(('forget', name, id))
+
+    new_cloud = {}
+    for id, item in sorted(cloud.items(), key=lambda kv: kv[1]['purchased']):
+        if id not in indexed_ids:
+            new_cloud.setdefault(local_name(item), []).append(id)
+    for name in sorted(local):
+        if name in index:
+            continue
+        if new_cloud.get(name):
+            actions.append(('link', name, new_cloud[name].pop(0)))
+        else:
+            actions.append(('upload', name, None))
+
+    taken = set(local) | set(index)
+    for name, ids in sorted(new_cloud.items()):
+        for id in ids:
+            actions.append(('download', _unique_name(name, taken), id))
+    return actions
+
+
+def sync(cloud, directory, jobs=4, delete=False, dry_run=False):
+    # cloud is a function returning the TolinoCloud to use in the calling
+    # thread (e.g. lambda: c). Returns one result per action:
+    #   {'action', 'file', 'document_id', 'status', 'error'}
+    # where status is 'done', 'unchanged' (a checked file with the same
+    # content), 'failed' or, with dry_run, 'planned'. A checked file with
+    # new content is uploaded again, its action becomes 'replace'.
+    from concurrent.futures import ThreadPoolExecutor
+    from requests.exceptions import RequestException
+    from tolinocloud import TolinoException
+
+    index = SyncIndex(os.path.join(directory, SYNC_INDEX_FILENAME))
+    try:
+        local = scan(directory)
+        entries = index.entries()
+        c = cloud()
+        items = dict((item['id'], item) for item in c.inventory() if item['type'] == 'edata')
+        actions = plan_sync(local, entries, items, delete)
+        if dry_run:
+            return [{'action': action, 'file': name, 'document_id': id, 'status': 'planned', 'error': None}
+                    for action, name, id in actions]
+
+        def upload(name, stat):
+            sha256 = sha256_file(os.path.join(directory, name))
+            id = cloud().upload(os.path.join(directory, name))
+            index.put(name, id, stat[0], stat[1], sha256)
+            return id
+
+        def run(action):
+            action, name, id = action
+            result = {'action': action, 'file': name, 'document_id': id, 'status': 'done', 'error': None}
+            filename = os.path.join(directory, name)
+            try:
+                if action == 'upload':
+                    result['document_id'] = upload(name, local[name])
+                elif action == 'download':
+                    fn, sha256 = cloud().download(directory, id, name, True)
+                    st = os.stat(filename)
+                    index.put(name, id, st.st_size, st.st_mtime_ns, sha256)
+                elif action == 'link':
+                    index.put(name, id, local[name][0], local[name][1], sha256_file(filename))
+                elif action == 'check':
+                    if sha256_file(filename) == entries[name]['sha256']:
+                        index.put(name, id, local[name][0], local[name][1], entries[name]['sha256'])
+                        result['status'] = 'unchanged'
+                    else:
+                        # the new content replaces the old document
+                        result['action'] = 'replace'
+                        result['document_id'] = upload(name, local[name])
+                        cloud().delete(id)
+                elif action == 'delete-local':
+                    os.remove(filename)
+                    index.remove(name)
+                elif action == 'delete-cloud':
+                    cloud().delete(id)
+                    index.remove(name)
+                elif action == 'forget':
+                    index.remove(name)
+            except (TolinoException, RequestException, OSError) as e:
+                result['status'] = 'failed'
+                result['error'] = str(e) or type(e).__name__
+                logging.info('sync of {} failed: {}'.format(name, result['error']))
+            return result
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            return list(executor.map(run, actions))
+    finally:
+        index.close()
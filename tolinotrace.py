@@ -0,0 +1,178 @@
+#HTTP tracing for the tolino cloud client
+
+# A Tracer records one entry per HTTP request of a TolinoCloud instance:
+#
+#   endpoint : name of the partner setting the url came from, e.g.
+#              'inventory' or 'downloadinfo', 'content' for book bodies
+#   method, status, bytes (body bytes received)
+#   dns, connect, tls : seconds spent on new connections, 0 if an idle
+#                       connection from the pool was reused
+#   ttfb     : seconds from sending the request until the response
+#              headers arrived
+#   total    : seconds until the body was read completely
+#
+# Tracing is off unless TolinoCloud.set_tracer() is called; only then
+# the instrumented connection pools are mounted on the session.
+#
+#   c.set_tracer(Tracer(JsonlTraceSink('trace.jsonl')))
+
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+
+import json
+import socket
+import threading
+import time
+from time import perf_counter
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# timings of the request currently sent by this thread
+_local = threading.local()
+
+
+class _TimedConnectionMixin:
+
+    def _new_conn(self):
+        timings = getattr(_local, 'timings', None)
+        if timings is None:
+            return super()._new_conn()
+
+        # resolve the host ourselves to tell DNS and TCP connect apart,
+        # urllib3 then connects to the address we found
+        t0 = perf_counter()
+        try:
+            address = socket.getaddrinfo(self._dns_host, self.port, 0, socket.SOCK_STREAM)[0][4][0]
+        except OSError:
+            # let urllib3 report the error the usual way
+            return super()._new_conn()
+        t1 = perf_counter()
+        dns_host = self._dns_host
+        self._dns_host = address
+        try:
+            sock = super()._new_conn()
+        finally:
+            self._dns_host = dns_host
+        timings['dns'] += t1 - t0
+        timings['connect'] += perf_counter() - t1
+        return sock
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+
+    def connect(self):
+        timings = getattr(_local, 'timings', None)
+        if timings is None:
+            return super().connect()
+        t0 = perf_counter()
+        before = timings['dns'] + timings['connect']
+        super().connect()
+        # whatever is not DNS or TCP connect is the TLS handshake
+        timings['tls'] += max(0.0, perf_counter() - t0 - (timings['dns'] + timings['connect'] - before))
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TracingAdapter(HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http'  : _TimedHTTPConnectionPool,
+            'https' : _TimedHTTPSConnectionPool
+        }
+
+
+class JsonlTraceSink:
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.f = open(filename, 'a')
+
+    def __call__(self, record):
+        line = json.dumps(record)
+        with self.lock:
+            self.f.write(line + '\n')
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+class Tracer:
+
+    def __init__(self, sink):
+        # sink is any callable taking a record dict
+        self.sink = sink
+
+    def install(self, session):
+        old = session.get_adapter('https://')
+        adapter = TracingAdapter(pool_connections=old._pool_connections, pool_maxsize=old._pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    def request(self, session, endpoint, method, url, **kwargs):
+        record = {
+            'time'     : time.time(),
+            'endpoint' : endpoint,
+            'method'   : method,
+            'status'   : None,
+            'bytes'    : 0,
+            'dns'      : 0.0,
+            'connect'  : 0.0,
+            'tls'      : 0.0,
+            'ttfb'     : None,
+            'total'    : None
+        }
+        _local.timings = record
+        start = perf_counter()
+        try:
+            r = session.request(method, url, **kwargs)
+        except Exception as e:
+            record['error'] = type(e).__name__
+            record['total'] = perf_counter() - start
+            self.sink(record)
+            raise
+        finally:
+            _local.timings = None
+        record['status'] = r.status_code
+        record['ttfb'] = r.elapsed.total_seconds()
+
+        if not kwargs.get('stream'):
+            record['bytes'] = len(r.content)
+            record['total'] = perf_counter() - start
+            self.sink(record)
+            return r
+
+        # streamed bodies are done when the caller closes the response
+        close = r.close
+        def traced_close():
+            close()
+            if record['total'] is None:
+                record['bytes'] = r.raw.tell()
+                record['total'] = perf_counter() - start
+                self.sink(record)
+        r.close = traced_close
+        return r